@@ -1,22 +1,54 @@
 #!/usr/bin/env python3
 """
 Formula image → LaTeX OCR using pix2tex.
-Usage: python formula_ocr.py <image_path> [image_path2 ...]
-       python formula_ocr.py --json <image_path1> <image_path2> ...
+Usage: python formula_ocr.py [--batch-size N] <image_path> [image_path2 ...]
+       python formula_ocr.py --json [--batch-size N] <image_path1> <image_path2> ...
+       python formula_ocr.py --serve [--socket PATH] [--queue N] [--batch-size N]
+       python formula_ocr.py --compare [--batch-size N] <image|dir|docx> ...
+All modes take --engine default|int8 (FORMULA_OCR_ENGINE sets the default).
 
 Returns LaTeX string for each image. With --json flag, returns JSON mapping.
+Images are bucketed by their model input size and run through the encoder / decoder
+in batches of --batch-size (1 = one forward pass per image, as pix2tex's own CLI).
+Results are cached by image content and model version in a SQLite file
+(FORMULA_OCR_CACHE overrides the path; "" disables), so formulas repeated across
+variants and re-imports skip inference.
+The int8 engine applies dynamic int8 quantization to the encoder / decoder linear
+layers for CPU servers; --compare runs every engine on the same images (formula
+images inside .docx files included) and reports time and agreement with default.
+--serve keeps the model loaded: JSONL requests {"id": ..., "paths": [...]} on stdin
+(or on a local Unix socket with --socket), one {"id": ..., "results": {path: latex}}
+line per request. Requests wait in a bounded queue for the single inference thread;
+socket requests beyond it get {"error": "busy"} at once.
 """
 import sys
 import json
 import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
 
+QUEUE_SIZE = 16  # pending requests before socket clients are told "busy"
+BATCH_SIZE = 8   # images per encoder / decoder pass
+BUCKET_W = 64    # images whose widths round up to the same multiple of this share a batch
+# LaTeX by image content (FORMULA_OCR_CACHE overrides; "" disables)
+CACHE_PATH = os.environ.get('FORMULA_OCR_CACHE',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'formula_ocr_cache.sqlite'))
+CACHE_MAX_ENTRIES = 50_000  # least recently used rows beyond this are evicted
+ENGINES = ('default', 'int8')
+ENGINE = os.environ.get('FORMULA_OCR_ENGINE', 'default')
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff')
 
-def ocr_formula(image_path: str, model) -> str:
-    """OCR a single formula image and return LaTeX string."""
+
+def load_image(image_path: str):
+    """Formula image prepared for pix2tex (upscaled if tiny, RGB on white), None if unreadable"""
     from PIL import Image
 
     if not os.path.exists(image_path):
-        return ''
+        return None
 
     try:
         img = Image.open(image_path)
@@ -35,7 +67,18 @@ def ocr_formula(image_path: str, model) -> str:
             else:
                 bg.paste(img)
             img = bg
+        return img
+    except Exception as e:
+        print(f"OCR error for {image_path}: {e}", file=sys.stderr)
+        return None
 
+
+def ocr_formula(image_path: str, model) -> str:
+    """OCR a single formula image and return LaTeX string."""
+    img = load_image(image_path)
+    if img is None:
+        return ''
+    try:
         result = model(img)
         return result.strip() if result else ''
     except Exception as e:
@@ -43,13 +86,573 @@ def ocr_formula(image_path: str, model) -> str:
         return ''
 
 
+def _model_input(model, img):
+    """LatexOCR.__call__ preprocessing without the forward pass: crop / pad to multiples
+    of 32, then the image_resizer loop that picks the resolution the model reads best.
+    Returns the padded RGB array."""
+    import numpy as np
+    import torch
+    from PIL import Image
+    from pix2tex.cli import minmax_size
+    from pix2tex.dataset.transforms import test_transform
+    from pix2tex.utils import pad
+
+    args = model.args
+    img = minmax_size(pad(img), args.max_dimensions, args.min_dimensions)
+    if model.image_resizer is not None and not args.get('no_resize'):
+        with torch.no_grad():
+            input_image = img.convert('RGB').copy()
+            r, w, h = 1, input_image.size[0], input_image.size[1]
+            for _ in range(10):
+                h = int(h * r)
+                resample = Image.BILINEAR if r > 1 else Image.LANCZOS
+                img = pad(minmax_size(input_image.resize((w, h), resample),
+                                      args.max_dimensions, args.min_dimensions))
+                t = test_transform(image=np.array(img.convert('RGB')))['image'][:1].unsqueeze(0)
+                w = (model.image_resizer(t.to(args.device)).argmax(-1).item() + 1) * 32
+                if w == img.size[0]:
+                    break
+                r = w / img.size[0]
+    else:
+        img = pad(img)
+    return np.array(img.convert('RGB'))
+
+
+def _decode_batch(model, arrays, width):
+    """One encoder + decoder pass over same-height arrays, white-padded to `width`"""
+    import numpy as np
+    import torch
+    from pix2tex.dataset.transforms import test_transform
+    from pix2tex.utils import post_process, token2str
+
+    args = model.args
+    batch = torch.stack([
+        test_transform(image=np.pad(a, ((0, 0), (0, width - a.shape[1]), (0, 0)),
+                                    constant_values=255))['image'][:1]
+        for a in arrays
+    ]).to(args.device)
+    with torch.no_grad():
+        dec = model.model.generate(batch, temperature=args.get('temperature', .25))
+    out = []
+    for tokens in dec:
+        # Rows that finished early keep decoding until the whole batch hits EOS
+        eos = (tokens == args.eos_token).nonzero()
+        if len(eos):
+            tokens = tokens[:int(eos[0, 0])]
+        out.append(post_process(token2str(tokens[None], model.tokenizer)[0]).strip())
+    return out
+
+
+def image_key(img):
+    """Content hash of a formula image: grayscale, cropped to the ink, so the same formula
+    saved again with other margins or colour mode gets the same key"""
+    import hashlib
+    from PIL import ImageOps
+
+    gray = img.convert('L')
+    box = ImageOps.invert(gray).point(lambda v: 255 if v > 32 else 0).getbbox()
+    if box:
+        gray = gray.crop(box)
+    return hashlib.sha256(f"{gray.size}".encode() + gray.tobytes()).hexdigest()
+
+
+def model_version(model):
+    """Cache namespace of a model: pix2tex version, checkpoint file and engine"""
+    try:
+        from importlib.metadata import version
+        pix2tex_version = version('pix2tex')
+    except Exception:
+        pix2tex_version = '?'
+    args = getattr(model, 'args', None) or {}
+    checkpoint = os.path.basename(str(args.get('checkpoint') or ''))
+    return f"pix2tex {pix2tex_version} {checkpoint} {getattr(model, 'engine', 'default')}"
+
+
+class LatexCache:
+    """LaTeX results by (image_key, model version) in a SQLite file shared by CLI runs and
+    servers. Rows beyond max_entries are evicted least recently used first; hits / misses
+    are counted for this process and in total. A SQLite error only turns the cache off.
+    One connection, used under a lock (the server's inference thread writes while
+    socket threads read stats)."""
+
+    def __init__(self, path, model_version, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self.entries = 0  # running row count: exact at open / after eviction, else an upper bound
+        self.lock = threading.Lock()
+        try:
+            self.db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            with self.db:
+                self.db.execute('CREATE TABLE IF NOT EXISTS latex (key TEXT NOT NULL, model TEXT NOT NULL, '
+                                'latex TEXT NOT NULL, used REAL NOT NULL, PRIMARY KEY (key, model))')
+                self.db.execute('CREATE INDEX IF NOT EXISTS latex_used ON latex (used)')
+                self.db.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            self.entries = self.db.execute('SELECT COUNT(*) FROM latex').fetchone()[0]
+        except sqlite3.Error as e:
+            self._disable(e)
+
+    def _disable(self, error):
+        print(f"LaTeX cache disabled ({self.path}): {error}", file=sys.stderr)
+        self.db = None
+
+    def get(self, keys):
+        """{key: latex} for the cached keys; marks them recently used"""
+        keys = list(keys)
+        if self.db is None or not keys:
+            return {}
+        found = {}
+        with self.lock:
+            try:
+                for i in range(0, len(keys), 500):  # SQLite host parameter limit
+                    chunk = keys[i:i + 500]
+                    found.update(self.db.execute(
+                        f"SELECT key, latex FROM latex WHERE model = ? AND key IN ({','.join('?' * len(chunk))})",
+                        [self.model_version, *chunk]).fetchall())
+                now = time.time()
+                with self.db:
+                    self.db.executemany('UPDATE latex SET used = ? WHERE key = ? AND model = ?',
+                                        [(now, k, self.model_version) for k in found])
+                    self.db.executemany('INSERT INTO counters VALUES (?, ?) '
+                                        'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                                        [('hits', len(found)), ('misses', len(keys) - len(found))])
+            except sqlite3.Error as e:
+                self._disable(e)
+                return {}
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, latex_by_key):
+        """Store new results, then evict down to 90% of max_entries if over it. The table
+        is only counted when the running count says it may be over."""
+        if self.db is None or not latex_by_key:
+            return
+        now = time.time()
+        with self.lock:
+            try:
+                with self.db:
+                    self.db.executemany('INSERT OR REPLACE INTO latex VALUES (?, ?, ?, ?)',
+                                        [(k, self.model_version, v, now) for k, v in latex_by_key.items()])
+                    self.entries += len(latex_by_key)
+                    if self.entries > self.max_entries:
+                        # Other processes share the file: count for real before evicting
+                        self.entries = self.db.execute('SELECT COUNT(*) FROM latex').fetchone()[0]
+                        excess = self.entries - int(self.max_entries * 0.9)
+                        if self.entries > self.max_entries:
+                            self.db.execute('DELETE FROM latex WHERE rowid IN '
+                                            '(SELECT rowid FROM latex ORDER BY used LIMIT ?)', (excess,))
+                            self.entries -= excess
+            except sqlite3.Error as e:
+                self._disable(e)
+
+    def stats(self):
+        """Counters of this process, all-time totals and the (running) size"""
+        with self.lock:
+            out = {"hits": self.hits, "misses": self.misses}
+            if self.db is None:
+                return out
+            try:
+                totals = dict(self.db.execute('SELECT name, value FROM counters').fetchall())
+                out["total_hits"] = totals.get('hits', 0)
+                out["total_misses"] = totals.get('misses', 0)
+                out["entries"] = self.entries
+            except sqlite3.Error:
+                pass
+        return out
+
+
+def open_cache(model, path=None):
+    """LatexCache at CACHE_PATH for this model, None when caching is disabled"""
+    path = CACHE_PATH if path is None else path
+    return LatexCache(path, model_version(model)) if path else None
+
+
+def ocr_formulas(image_paths, model, batch_size=BATCH_SIZE, cache=None):
+    """OCR many formula images -> {path: latex}. Identical images (by image_key) are
+    read once and looked up in `cache` first; the rest go through _run_model."""
+    images = {}
+    for p in dict.fromkeys(image_paths):
+        img = load_image(p)
+        if img is not None:
+            images[p] = img
+    keys = {}
+    for p, img in images.items():
+        try:
+            keys[p] = image_key(img)
+        except Exception as e:
+            print(f"OCR error for {p}: {e}", file=sys.stderr)
+    cached = cache.get(set(keys.values())) if cache else {}
+    pending = {}  # content key -> first path with it
+    for p, k in keys.items():
+        if k not in cached:
+            pending.setdefault(k, p)
+
+    found = _run_model({p: images[p] for p in pending.values()}, model, batch_size)
+    fresh = {k: found[p] for k, p in pending.items() if found.get(p)}
+    if cache:
+        cache.put(fresh)
+    latex = {**cached, **fresh}
+    return {p: latex.get(keys[p], '') if p in keys else '' for p in image_paths}
+
+
+def _run_model(images, model, batch_size):
+    """{path: PIL image} -> {path: latex}. Images whose model input has the same height
+    and width bucket share a forward pass, white-padded on the right to the widest of
+    the batch only (a lone image keeps its exact input); falls back to one image at a
+    time if batch_size is 1 or this pix2tex version does not expose the pieces used."""
+    result = {p: '' for p in images}
+
+    def one_by_one(paths):
+        for p in paths:
+            try:
+                latex = model(images[p])
+                result[p] = latex.strip() if latex else ''
+            except Exception as e:
+                print(f"OCR error for {p}: {e}", file=sys.stderr)
+
+    if batch_size <= 1 or len(images) <= 1:
+        one_by_one(images)
+        return result
+    arrays = {}
+    for p, img in images.items():
+        try:
+            arrays[p] = _model_input(model, img)
+        except (ImportError, AttributeError) as e:
+            print(f"Batched OCR unavailable ({e}), one image at a time", file=sys.stderr)
+            one_by_one(images)
+            return result
+        except Exception as e:  # e.g. cv2.error in pad() on a blank image — only this one is lost
+            print(f"OCR error for {p}: {e}", file=sys.stderr)
+
+    max_w = model.args.max_dimensions[0]
+    buckets = {}
+    for p, a in arrays.items():
+        h, w = a.shape[:2]
+        buckets.setdefault((h, min(-(-w // BUCKET_W) * BUCKET_W, max_w)), []).append(p)
+    for _, paths in sorted(buckets.items()):
+        for i in range(0, len(paths), batch_size):
+            chunk = paths[i:i + batch_size]
+            width = max(arrays[p].shape[1] for p in chunk)
+            try:
+                for p, latex in zip(chunk, _decode_batch(model, [arrays[p] for p in chunk], width)):
+                    result[p] = latex
+            except Exception as e:  # e.g. out of memory — retry this chunk singly
+                print(f"Batch OCR error ({e}), retrying {len(chunk)} images singly", file=sys.stderr)
+                one_by_one(chunk)
+    return result
+
+
+def _pop_option(args, name, default, cast=str, choices=None):
+    """Remove `name VALUE` from the argument list and return the cast value;
+    ValueError if the value is missing, does not cast or is not one of choices"""
+    if name not in args:
+        return default
+    i = args.index(name)
+    if i + 1 >= len(args):
+        raise ValueError(f"{name} needs a value")
+    try:
+        value = cast(args[i + 1])
+    except ValueError:
+        raise ValueError(f"{name}: invalid value {args[i + 1]!r}") from None
+    if choices and value not in choices:
+        raise ValueError(f"{name} must be one of {', '.join(choices)}, got {value!r}")
+    del args[i:i + 2]
+    return value
+
+
+def _exit_error(message, json_mode):
+    """Usual CLI failure: message on stderr, an empty mapping for --json callers"""
+    print(message, file=sys.stderr)
+    if json_mode:
+        print("{}")
+    sys.exit(1)
+
+
+def load_model(engine=ENGINE):
+    """pix2tex LatexOCR (~500MB first time, cached after) on the given engine;
+    ImportError if not installed"""
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine!r}, expected one of {', '.join(ENGINES)}")
+    from pix2tex.cli import LatexOCR
+    model = LatexOCR()
+    model.engine = 'default'
+    if engine == 'int8':
+        quantize_int8(model)
+    return model
+
+
+def quantize_int8(model):
+    """Dynamic int8 quantization of the encoder / decoder nn.Linear layers: int8 weights,
+    activations quantized on the fly. CPU only; the image_resizer (convolutions) stays float."""
+    import torch
+
+    if str(model.args.device) != 'cpu':
+        print(f"int8 engine needs CPU, keeping float model on {model.args.device}", file=sys.stderr)
+        return model
+    model.model = torch.ao.quantization.quantize_dynamic(model.model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.engine = 'int8'
+    return model
+
+
+def collect_images(paths, tmp_dir):
+    """[(label, image path)] from image files, directories (non-recursive) and .docx
+    files, whose word/media images are extracted into tmp_dir"""
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            images.extend(collect_images([os.path.join(path, f) for f in sorted(os.listdir(path))
+                                          if f.lower().endswith(IMAGE_EXTS + ('.docx',))], tmp_dir))
+        elif path.lower().endswith('.docx'):
+            with zipfile.ZipFile(path) as z:
+                for name in sorted(z.namelist()):
+                    if name.startswith('word/media/') and name.lower().endswith(IMAGE_EXTS):
+                        out = os.path.join(tmp_dir, f"{len(images)}_{os.path.basename(name)}")
+                        with open(out, 'wb') as f:
+                            f.write(z.read(name))
+                        images.append((f"{os.path.basename(path)}:{name}", out))
+        elif os.path.isfile(path):
+            images.append((path, path))
+    return images
+
+
+def _edit_distance(a, b):
+    """Levenshtein distance, two-row DP"""
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+def compare_engines(paths, engines=ENGINES, batch_size=BATCH_SIZE, max_mismatches=20):
+    """Run each engine over the same images (no cache, after a one-image warm-up) and
+    compare with the first engine: exact matches and character error rate of the
+    whitespace-free LaTeX, load / OCR time and speedup."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        images = collect_images(paths, tmp_dir)
+        files = [p for _, p in images]
+        runs = {}
+        for engine in engines:
+            t0 = time.perf_counter()
+            model = load_model(engine)
+            load_s = time.perf_counter() - t0
+            ocr_formulas(files[:1], model, batch_size)
+            t0 = time.perf_counter()
+            result = ocr_formulas(files, model, batch_size)
+            runs[engine] = {"engine": model.engine, "load_s": load_s,
+                            "ocr_s": time.perf_counter() - t0, "result": result}
+            del model
+
+    ref = runs[engines[0]]
+    report = {"images": len(images), "batch_size": batch_size, "reference": engines[0], "engines": {}}
+    for engine, run in runs.items():
+        exact, cer, mismatches = 0, [], []
+        for label, p in images:
+            a = ''.join(ref["result"][p].split())
+            b = ''.join(run["result"][p].split())
+            exact += a == b
+            cer.append(_edit_distance(a, b) / max(1, len(a)))
+            if a != b and len(mismatches) < max_mismatches:
+                mismatches.append({"image": label, engines[0]: ref["result"][p], engine: run["result"][p]})
+        info = {
+            "engine": run["engine"],
+            "load_s": round(run["load_s"], 2),
+            "ocr_s": round(run["ocr_s"], 2),
+            "ms_per_image": round(run["ocr_s"] * 1000 / max(1, len(images)), 1),
+            "speedup": round(ref["ocr_s"] / run["ocr_s"], 2) if run["ocr_s"] > 0 else None,
+            "exact_match": round(exact / max(1, len(images)), 3),
+            "mean_cer": round(sum(cer) / max(1, len(cer)), 4),
+            "recognized": sum(1 for _, p in images if run["result"][p]),
+        }
+        if engine != engines[0]:
+            info["mismatches"] = mismatches
+        report["engines"][engine] = info
+    return report
+
+
+class OcrServer:
+    """Model loaded once; requests from every front end go through one bounded queue to
+    a single inference thread (pix2tex is not thread-safe)."""
+
+    def __init__(self, model, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, cache=None):
+        self.model = model
+        self.batch_size = batch_size
+        self.cache = cache
+        self.queue = queue.Queue(maxsize=queue_size)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, request, reply, block=False):
+        """Queue a request; reply(response) is called from the inference thread. When the
+        queue is full: wait if block, else reply "busy" immediately."""
+        if 'error' in request:  # rejected by _parse_request
+            reply(request)
+            return
+        if request.get('cmd') == 'ping':
+            response = {"id": request.get('id'), "ok": True, "queued": self.queue.qsize()}
+            if self.cache:
+                response["cache"] = self.cache.stats()
+            reply(response)
+            return
+        try:
+            self.queue.put((request, reply), block=block)
+        except queue.Full:
+            reply({"id": request.get('id'), "error": "busy", "queued": self.queue.qsize()})
+
+    def _run(self):
+        while True:
+            request, reply = self.queue.get()
+            try:
+                try:
+                    response = self.handle(request)
+                except Exception as e:
+                    response = {"id": request.get('id'), "error": str(e)}
+                reply(response)
+            except Exception as e:  # a broken client must not stop the server
+                print(f"OCR server error: {e}", file=sys.stderr)
+            finally:
+                self.queue.task_done()
+
+    def handle(self, request):
+        paths = request.get('paths') or ([request['path']] if request.get('path') else [])
+        t0 = time.perf_counter()
+        hits = self.cache.hits if self.cache else 0
+        results = ocr_formulas(paths, self.model, self.batch_size, self.cache)
+        response = {"id": request.get('id'), "results": results,
+                    "ms": round((time.perf_counter() - t0) * 1000, 1)}
+        if self.cache:
+            response["cached"] = self.cache.hits - hits
+        return response
+
+
+def _parse_request(line):
+    """JSONL line -> request dict: an object, a JSON list of paths, a JSON string or a bare
+    path. Anything else, or non-string paths, -> {"error": ...} (replied at once)."""
+    try:
+        request = json.loads(line)
+    except ValueError:
+        return {"path": line}  # bare image path
+    if isinstance(request, str):
+        request = {"path": request}
+    elif isinstance(request, list):
+        request = {"paths": request}
+    elif not isinstance(request, dict):
+        return {"error": "bad request: expected an object, a list of paths or a path"}
+    paths = request.get('paths') or []
+    if (not isinstance(request.get('path') or '', str) or not isinstance(paths, list)
+            or not all(isinstance(p, str) for p in paths)):
+        return {"id": request.get('id'), "error": "bad request: paths must be strings"}
+    return request
+
+
+def serve_stdin(server):
+    """JSONL on stdin -> JSONL on stdout; a full queue blocks reading (pipe backpressure)"""
+    lock = threading.Lock()
+
+    def reply(response):
+        with lock:
+            sys.stdout.write(json.dumps(response, ensure_ascii=False) + "\n")
+            sys.stdout.flush()
+
+    sys.stdin.reconfigure(errors='replace')  # as on the socket: one bad line must not stop the server
+    for line in sys.stdin:
+        line = line.strip()
+        if line:
+            server.submit(_parse_request(line), reply, block=True)
+    server.queue.join()
+
+
+def serve_socket(server, path):
+    """JSONL over a local Unix socket; each connection may send several requests"""
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for raw in self.rfile:
+                # Undecodable bytes end up in an unreadable path: an error reply, not a dropped connection
+                line = raw.decode('utf-8', 'replace').strip()
+                if not line:
+                    continue
+                done = threading.Event()
+                box = {}
+
+                def reply(response):
+                    box['response'] = response
+                    done.set()
+
+                server.submit(_parse_request(line), reply)
+                done.wait()
+                self.wfile.write((json.dumps(box['response'], ensure_ascii=False) + "\n").encode('utf-8'))
+                self.wfile.flush()
+
+    if os.path.exists(path):
+        os.unlink(path)  # stale socket from a previous run
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as srv:
+        os.chmod(path, 0o660)
+        srv.daemon_threads = True
+        print(f"OCR server listening on {path}", file=sys.stderr)
+        try:
+            srv.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+def serve(args):
+    try:
+        socket_path = _pop_option(args, '--socket', None)
+        queue_size = _pop_option(args, '--queue', QUEUE_SIZE, int)
+        batch_size = _pop_option(args, '--batch-size', BATCH_SIZE, int)
+        engine = _pop_option(args, '--engine', ENGINE, choices=ENGINES)
+        model = load_model(engine)  # ValueError too if FORMULA_OCR_ENGINE is unknown
+    except ImportError:
+        print(json.dumps({"error": "pix2tex not installed. Install: pip install pix2tex"}))
+        sys.exit(1)
+    except ValueError as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
+    print(f"OCR server: {model.engine} engine, cache key {model_version(model)!r}", file=sys.stderr)
+    server = OcrServer(model, queue_size, batch_size, open_cache(model))
+    if socket_path:
+        serve_socket(server, socket_path)
+    else:
+        serve_stdin(server)
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        serve(sys.argv[2:])
+        return
+
     if len(sys.argv) < 2:
         print("Usage: python formula_ocr.py [--json] <image_path> [image_path2 ...]", file=sys.stderr)
         sys.exit(1)
 
-    json_mode = sys.argv[1] == '--json'
-    paths = sys.argv[2:] if json_mode else sys.argv[1:]
+    args = sys.argv[1:]
+    try:
+        batch_size = _pop_option(args, '--batch-size', BATCH_SIZE, int)
+        engine = _pop_option(args, '--engine', ENGINE, choices=ENGINES)
+    except ValueError as e:
+        if '--compare' in args:
+            print(json.dumps({"error": str(e)}))
+            sys.exit(1)
+        _exit_error(str(e), '--json' in args)
+    if args and args[0] == '--compare':
+        try:
+            report = compare_engines(args[1:], batch_size=batch_size)
+        except ImportError:
+            print(json.dumps({"error": "pix2tex not installed. Install: pip install pix2tex"}))
+            sys.exit(1)
+        print(json.dumps(report, ensure_ascii=False, indent=1))
+        return
+
+    json_mode = bool(args) and args[0] == '--json'
+    if json_mode:
+        args = args[1:]
+    paths = args
 
     if not paths:
         print("{}" if json_mode else "")
@@ -57,24 +660,23 @@ def main():
 
     # Load model once (heavy — ~500MB first time, cached after)
     try:
-        from pix2tex.cli import LatexOCR
-        model = LatexOCR()
+        model = load_model(engine)
     except ImportError:
-        print("pix2tex not installed. Install: pip install pix2tex", file=sys.stderr)
-        if json_mode:
-            print("{}")
-        sys.exit(1)
+        _exit_error("pix2tex not installed. Install: pip install pix2tex", json_mode)
+    except ValueError as e:  # FORMULA_OCR_ENGINE names an unknown engine
+        _exit_error(str(e), json_mode)
 
+    cache = open_cache(model)
+    result = ocr_formulas(paths, model, batch_size, cache)
+    if cache:
+        stats = cache.stats()
+        print(f"LaTeX cache: {stats['hits']} hits, {stats['misses']} misses, "
+              f"{stats.get('entries', 0)} entries", file=sys.stderr)
     if json_mode:
-        result = {}
-        for p in paths:
-            latex = ocr_formula(p, model)
-            result[p] = latex
         print(json.dumps(result))
     else:
         for p in paths:
-            latex = ocr_formula(p, model)
-            print(latex)
+            print(result[p])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Grading engine - ko'p variantli javob kalitlari bilan paketli baholash
+Every variant's key is loaded once into compact arrays (uint8 letters, float32 points,
+int16 subject index). A batch of sheets is scored as one (sheets x questions)
+comparison against the keys of their variants, with per-subject subtotals for block
+tests. Scores match HybridOMR.scan: percentage = correct / sheet questions.
+
+Usage: python grading.py <keys_json> <sheets_json>
+  keys_json:   {"VARIANT": [{"correctAnswer": "A", "subjectId": "...", "points": 1}, ...]}
+               (StudentVariant.shuffledQuestions order) or {"VARIANT": {"1": "A", ...}}
+  sheets_json: [{"variant": "VARIANT", "detected_answers": {...}, "invalid_answers": {...}}]
+               or a HybridOMR.scan / scan_multi result
+"""
+
+import json
+import sys
+
+import numpy as np
+
+LETTERS = 'ABCD'
+BLANK = 0    # no key / no answer
+MULTI = 255  # several bubbles marked (invalid_answers)
+OTHER = 254  # a letter outside ABCD (key or sheet): keyed / answered, never correct
+_CODE = {letter: i + 1 for i, letter in enumerate(LETTERS)}
+
+
+def variant_code(qr_data):
+    """Variant code from QR text: JSON {"c": code, "q": total} or the plain string
+    (same rules as parseQrData in omr.routes.ts), normalized for key lookup. For a
+    qr_scanner result the raw text is used: its 'data' is cleaned of JSON punctuation."""
+    if isinstance(qr_data, dict):
+        qr_data = next((qr_data[k] for k in ('raw', 'data', 'c') if qr_data.get(k)), None)
+    if not qr_data:
+        return None
+    try:
+        parsed = json.loads(qr_data)
+        if isinstance(parsed, dict) and parsed.get('c'):
+            qr_data = parsed['c']
+    except (TypeError, ValueError):
+        pass
+    return str(qr_data).strip().upper()
+
+
+def encode_answers(detected_answers, n_questions, invalid_answers=None):
+    """Sheet answers {"1": "A", ...} (+ invalid_answers) -> uint8 row of n_questions"""
+    row = np.zeros(n_questions, dtype=np.uint8)
+    for q, letter in (detected_answers or {}).items():
+        qi = int(q) - 1
+        if 0 <= qi < n_questions:
+            row[qi] = _CODE.get(letter, OTHER) if letter else BLANK
+    for q in (invalid_answers or {}):
+        qi = int(q) - 1
+        if 0 <= qi < n_questions:
+            row[qi] = MULTI
+    return row
+
+
+class AnswerKeys:
+    """All variant keys of a test, compiled once; grade() scores whole batches."""
+
+    def __init__(self, variants, n_questions=None):
+        """variants: {code: key}; key is a list of question dicts (correctAnswer,
+        optional subjectId / points / originalQuestionIndex / variants), a list of
+        letters, or a {"1": "A"} dict."""
+        parsed = {str(code).strip().upper(): self._parse_key(key) for code, key in variants.items()}
+        width = max([len(k) for k in parsed.values()] + [n_questions or 0, 1])
+
+        self.codes = {code: i for i, code in enumerate(parsed)}
+        self.subjects = []  # subject ids in first-seen order
+        subject_index = {}
+        n = len(parsed)
+        self.keys = np.zeros((n, width), dtype=np.uint8)
+        self.points = np.zeros((n, width), dtype=np.float32)
+        self.subject_of = np.full((n, width), -1, dtype=np.int16)
+        self.n_questions = np.zeros(n, dtype=np.int32)
+        # Shuffled variants: original question index per position and the printed letter
+        # -> canonical option (1-4, first-seen order of the option text; BLANK past the
+        # 4th distinct text, flagged per item in option_overflow) per question
+        self.item_of = np.tile(np.arange(width, dtype=np.int32), (n, 1))
+        self.option_of = np.tile(np.arange(len(LETTERS) + 1, dtype=np.uint8), (n, width, 1))
+        option_ids = {}  # item -> {option text: canonical code}
+        overflow = set()  # items with more distinct option texts than letters
+
+        for i, key in enumerate(parsed.values()):
+            self.n_questions[i] = n_questions or len(key)
+            for qi, (letter, subject, points, item, options) in enumerate(key):
+                if subject is not None and subject not in subject_index:
+                    subject_index[subject] = len(self.subjects)
+                    self.subjects.append(subject)
+                if subject is not None:
+                    self.subject_of[i, qi] = subject_index[subject]
+                self.keys[i, qi] = _CODE.get(letter, OTHER) if letter else BLANK
+                self.points[i, qi] = points if self.keys[i, qi] else 0.0
+                if item is not None:
+                    self.item_of[i, qi] = item
+                texts = option_ids.setdefault(int(self.item_of[i, qi]), {})
+                for printed, text in enumerate(options[:len(LETTERS)], 1):
+                    code = texts.setdefault(text, len(texts) + 1)
+                    if code > len(LETTERS):  # 5th+ text: unmapped (BLANK), never merged into another
+                        overflow.add(int(self.item_of[i, qi]))
+                        code = BLANK
+                    self.option_of[i, qi, printed] = code
+        self.n_items = int(self.item_of.max()) + 1 if n else 0
+        self.option_overflow = np.zeros(self.n_items, dtype=bool)
+        self.option_overflow[sorted(overflow)] = True
+
+    @staticmethod
+    def _parse_key(key):
+        """-> [(letter, subject_id or None, points, original index or None, option texts)]
+        in sheet order"""
+        if isinstance(key, dict):
+            # Legacy correct_answers: only "1".."N" can match a sheet's question numbers
+            numbered = {int(q): letter for q, letter in key.items() if str(q).isdigit() and int(q) > 0}
+            size = max(numbered, default=0)
+            return [(numbered.get(q + 1), None, 1.0, None, []) for q in range(size)]
+        out = []
+        for item in key:
+            if isinstance(item, dict):
+                subject = item.get('subjectId')
+                original = item.get('originalQuestionIndex')
+                options = [str(v.get('text', '')) + str(v.get('formula') or '') + str(v.get('imageUrl') or '')
+                           for v in item.get('variants') or [] if isinstance(v, dict)]
+                out.append((item.get('correctAnswer'), str(subject) if subject else None,
+                            float(item.get('points') or 1), int(original) if original is not None else None,
+                            options))
+            else:
+                out.append((item, None, 1.0, None, []))
+        return out
+
+    @classmethod
+    def load(cls, source, n_questions=None):
+        """From a JSON file path, JSON text or an already parsed dict"""
+        if isinstance(source, str):
+            if source.lstrip().startswith('{'):
+                source = json.loads(source)
+            else:
+                with open(source, 'r', encoding='utf-8') as f:
+                    source = json.load(f)
+        return cls(source, n_questions)
+
+    def variant_index(self, code):
+        """Row of a variant code (case-insensitive), -1 if unknown"""
+        if code is None:
+            return -1
+        return self.codes.get(str(code).strip().upper(), -1)
+
+    def answer_matrix(self, answers):
+        """(sheets, key width) uint8 matrix from a list of (detected_answers,
+        invalid_answers) pairs, or an encoded matrix trimmed / padded to the key width"""
+        width = self.keys.shape[1]
+        if not isinstance(answers, np.ndarray):
+            answers = np.stack([encode_answers(d, width, inv) for d, inv in answers]) if len(answers) \
+                else np.zeros((0, width), dtype=np.uint8)
+        answers = answers[:, :width]
+        if answers.shape[1] < width:
+            answers = np.pad(answers, ((0, 0), (0, width - answers.shape[1])))
+        return answers
+
+    def grade(self, variants, answers):
+        """Score a batch. variants: code per sheet; answers: (sheets, questions) uint8
+        matrix (encode_answers) or list of (detected_answers, invalid_answers) pairs.
+        Returns one dict per sheet, {"error": ...} for unknown variants."""
+        idx = np.array([self.variant_index(v) for v in variants], dtype=np.int64)
+        answers = self.answer_matrix(answers)
+
+        known = idx >= 0
+        rows = np.where(known, idx, 0)
+        keys = self.keys[rows]                   # (S, Q)
+        keyed = keys != BLANK
+        answered = (answers != BLANK) & (answers != MULTI)
+        correct = keyed & (answers == keys) & (keys != OTHER)
+        incorrect = keyed & answered & ~correct
+        earned = np.where(correct, self.points[rows], 0.0)
+
+        n_correct = correct.sum(axis=1)
+        n_incorrect = incorrect.sum(axis=1)
+        n_answered = answered.sum(axis=1)
+        n_invalid = (answers == MULTI).sum(axis=1)
+        total = self.n_questions[rows]
+        points = earned.sum(axis=1)
+        max_points = self.points[rows].sum(axis=1)
+
+        # Per-subject subtotals: one bincount over (sheet, subject) cells
+        n_subj = len(self.subjects)
+        if n_subj:
+            subj = self.subject_of[rows].astype(np.int64)
+            has = subj >= 0
+            cell = (np.arange(len(rows))[:, None] * n_subj + subj)[has]
+            size = len(rows) * n_subj
+            subj_correct = np.bincount(cell, weights=correct[has], minlength=size).reshape(-1, n_subj)
+            subj_total = np.bincount(cell, weights=keyed[has], minlength=size).reshape(-1, n_subj)
+            subj_points = np.bincount(cell, weights=earned[has], minlength=size).reshape(-1, n_subj)
+            subj_max = np.bincount(cell, weights=self.points[rows][has], minlength=size).reshape(-1, n_subj)
+
+        results = []
+        for s, variant in enumerate(variants):
+            if not known[s]:
+                results.append({"variant": variant, "error": f"Unknown variant: {variant}"})
+                continue
+            pct = n_correct[s] / total[s] * 100 if total[s] > 0 else 0
+            res = {
+                "variant": variant,
+                "correct": int(n_correct[s]),
+                "incorrect": int(n_incorrect[s]),
+                "unanswered": int(total[s] - n_answered[s] - n_invalid[s]),
+                "score": f"{pct:.1f}%",
+                "points": float(points[s]),
+                "max_points": float(max_points[s]),
+            }
+            if n_subj:
+                res["subjects"] = [
+                    {"subject_id": self.subjects[j], "correct": int(subj_correct[s, j]),
+                     "total": int(subj_total[s, j]), "points": float(subj_points[s, j]),
+                     "max_points": float(subj_max[s, j])}
+                    for j in range(n_subj) if subj_total[s, j] > 0
+                ]
+            results.append(res)
+        return results
+
+
+def sheets_from(data):
+    """Sheet list from sheets_json: explicit list, scan_multi result or a single scan"""
+    if isinstance(data, dict) and 'pages' in data:
+        data = data['pages']
+    elif isinstance(data, dict):
+        data = [data]
+    return [s for s in data if s.get('success', True)]
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(json.dumps({"success": False, "error": "Usage: python grading.py <keys_json> <sheets_json>"}))
+        sys.exit(1)
+
+    try:
+        keys = AnswerKeys.load(sys.argv[1])
+        with open(sys.argv[2], 'r', encoding='utf-8') as f:
+            sheets = sheets_from(json.load(f))
+    except (OSError, ValueError) as e:
+        print(json.dumps({"success": False, "error": str(e)}))
+        sys.exit(1)
+
+    variants = [s.get('variant') or variant_code(s.get('qr')) for s in sheets]
+    answers = [(s.get('detected_answers'), s.get('invalid_answers')) for s in sheets]
+    print(json.dumps({"success": True, "results": keys.grade(variants, answers)}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
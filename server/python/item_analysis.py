@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Item analysis - imtihondan keyin savollar tahlili (butun kohorta bo'yicha)
+Scan results are ingested into (sheets x items) arrays; shuffled variants are mapped
+back to the original question and option through grading.AnswerKeys. Everything below
+is computed for the whole cohort at once:
+  difficulty      share of sheets answering the item correctly (p-value)
+  discrimination  point-biserial r of the item vs. the rest score, and the
+                  upper-lower 27% index
+  distractors     per item: blank / option 1-4 / multi-marked counts
+  similarity      sheet pairs sharing more identical wrong answers than chance predicts
+                  from the items both got wrong (W @ W.T vs. expected overlap, as z)
+Exported as compressed .npz (one array per column) or .json for the statistics pages.
+
+Usage: python item_analysis.py <keys_json> <out.npz|out.json> <results_json> [results_json ...]
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+
+from grading import AnswerKeys, BLANK, MULTI, OTHER, LETTERS, sheets_from, variant_code
+
+UPPER_LOWER = 0.27  # Kelley: top / bottom 27% of total scores
+
+
+def cohort_matrices(keys, variants, answers):
+    """Sheets -> item space. variants: code per sheet; answers: as AnswerKeys.grade.
+    Returns dict: responses (S, I) uint8 canonical options (BLANK / 1-4 / MULTI; an
+    option beyond the item's 4th distinct text reads as BLANK, see option_overflow),
+    correct / keyed (S, I) bool, key (I,) canonical correct option, known (sheets,) bool
+    (sheets with an unknown variant are left out of S)."""
+    idx = np.array([keys.variant_index(v) for v in variants], dtype=np.int64)
+    known = idx >= 0
+    answers = keys.answer_matrix(answers)[known]
+    rows = idx[known]
+    n_sheets, width = answers.shape
+    n_items = keys.n_items
+
+    key = keys.keys[rows]
+    cols = np.arange(width)[None, :]
+    # Letters outside ABCD have no canonical option: blank response / no key option
+    printed = np.where((answers == MULTI) | (answers == OTHER), BLANK, answers)
+    options = keys.option_of[rows[:, None], cols, printed]
+    options = np.where(answers == MULTI, MULTI, options).astype(np.uint8)
+    items = keys.item_of[rows]
+    sel = key != BLANK
+    sheet = np.broadcast_to(np.arange(n_sheets)[:, None], (n_sheets, width))[sel]
+
+    responses = np.zeros((n_sheets, n_items), dtype=np.uint8)
+    correct = np.zeros((n_sheets, n_items), dtype=bool)
+    keyed = np.zeros((n_sheets, n_items), dtype=bool)
+    responses[sheet, items[sel]] = options[sel]
+    correct[sheet, items[sel]] = ((answers == key) & (key != OTHER))[sel]
+    keyed[sheet, items[sel]] = True
+
+    key_items = np.zeros(n_items, dtype=np.uint8)
+    key_items[items[sel]] = keys.option_of[rows[:, None], cols, np.where(key == OTHER, BLANK, key)][sel]
+    return {"responses": responses, "correct": correct, "keyed": keyed,
+            "key": key_items, "known": known}
+
+
+def analyze(responses, correct, keyed, key=None, min_shared=5, min_z=4.0, max_pairs=50):
+    """Cohort statistics from (S, I) matrices; returns a dict of numpy arrays."""
+    n_sheets, n_items = responses.shape
+    C = correct.astype(np.float64)
+    K = keyed.astype(np.float64)
+    n = K.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        difficulty = C.sum(axis=0) / n
+
+        # Point-biserial r(item, rest score) over the sheets that had the item
+        total = C.sum(axis=1)
+        rest = (total[:, None] - C) * K
+        mx, my = C.sum(axis=0) / n, rest.sum(axis=0) / n
+        cov = (C * rest).sum(axis=0) / n - mx * my
+        var_y = (rest * rest).sum(axis=0) / n - my * my
+        discrimination = cov / np.sqrt(mx * (1 - mx) * var_y)
+
+        # Upper-lower index on total score
+        k = max(1, int(round(n_sheets * UPPER_LOWER)))
+        order = np.argsort(total, kind='stable')
+        lower, upper = order[:k], order[-k:]
+        discrimination_ul = (C[upper].sum(axis=0) / K[upper].sum(axis=0)
+                             - C[lower].sum(axis=0) / K[lower].sum(axis=0))
+
+    # Distractors: [blank, option 1..4, multi] counts per item, one bincount
+    codes = np.where(responses == MULTI, len(LETTERS) + 1, responses).astype(np.int64)
+    cell = (np.arange(n_items)[None, :] * (len(LETTERS) + 2) + codes)[keyed]
+    distractors = np.bincount(cell, minlength=n_items * (len(LETTERS) + 2)).reshape(n_items, -1)
+
+    # Similarity: identical wrong answers shared by two sheets = W @ W.T over one-hot
+    # (sheet, item x option) wrong answers. Expected overlap given the items both got
+    # wrong: per item, two wrong answers match with chance m = sum(option share^2)
+    wrong = keyed & ~correct & (responses != BLANK) & (responses != MULTI)
+    s_idx, i_idx = np.nonzero(wrong)
+    W = np.zeros((n_sheets, n_items * len(LETTERS)), dtype=np.float32)
+    W[s_idx, i_idx * len(LETTERS) + responses[s_idx, i_idx].astype(np.int64) - 1] = 1.0
+    shared = W @ W.T
+    share = W.sum(axis=0).reshape(n_items, len(LETTERS))
+    share = share / np.maximum(1.0, share.sum(axis=1, keepdims=True))
+    match = (share * share).sum(axis=1).astype(np.float32)
+    wrong_f = wrong.astype(np.float32)
+    expected = (wrong_f * match) @ wrong_f.T
+    variance = (wrong_f * (match * (1 - match))) @ wrong_f.T
+    a, b = np.triu_indices(n_sheets, 1)
+    pair_shared, pair_expected = shared[a, b], expected[a, b]
+    pair_z = (pair_shared - pair_expected) / np.sqrt(np.maximum(variance[a, b], 1e-6))
+    flagged = np.flatnonzero((pair_z >= min_z) & (pair_shared >= min_shared))
+    flagged = flagged[np.argsort(-pair_z[flagged], kind='stable')][:max_pairs]
+    pair_a, pair_b = a[flagged], b[flagged]
+
+    return {
+        "n": n.astype(np.int32),
+        "difficulty": difficulty.astype(np.float32),
+        "discrimination": discrimination.astype(np.float32),
+        "discrimination_ul": discrimination_ul.astype(np.float32),
+        "distractors": distractors.astype(np.int32),
+        "key": key if key is not None else np.zeros(n_items, dtype=np.uint8),
+        "total_score": total.astype(np.float32),
+        "pair_a": pair_a.astype(np.int32),
+        "pair_b": pair_b.astype(np.int32),
+        "pair_shared": pair_shared[flagged].astype(np.int32),
+        "pair_expected": pair_expected[flagged].astype(np.float32),
+        "pair_z": pair_z[flagged].astype(np.float32),
+    }
+
+
+def export(stats, path):
+    """.npz (compressed, one array per column) or .json (NaN -> null)"""
+    if path.endswith('.json'):
+        out = {}
+        for name, arr in stats.items():
+            arr = np.asarray(arr)
+            if arr.dtype.kind == 'f':
+                out[name] = np.where(np.isnan(arr), None, np.round(arr.astype(np.float64), 4)).tolist()
+            else:
+                out[name] = arr.tolist()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(out, f, ensure_ascii=False)
+    else:
+        np.savez_compressed(path, **{name: np.asarray(arr) for name, arr in stats.items()})
+    return path
+
+
+def analyze_results(keys, sheets, sheet_ids=None, **kwargs):
+    """Scan / grading results (dicts with variant or qr, detected_answers, invalid_answers,
+    optional student_id) -> stats dict, including sheet_ids of the analysed sheets:
+    student_id, else the sheet_ids label (e.g. result file name), else the sheet's index
+    (never the variant code, which many sheets share), and option_overflow per item
+    (distractor counts incomplete: more than 4 distinct option texts across variants)."""
+    variants = [s.get('variant') or variant_code(s.get('qr')) for s in sheets]
+    answers = [(s.get('detected_answers'), s.get('invalid_answers')) for s in sheets]
+    cohort = cohort_matrices(keys, variants, answers)
+    stats = analyze(cohort["responses"], cohort["correct"], cohort["keyed"], cohort["key"], **kwargs)
+    ids = [str(s.get('student_id') or (sheet_ids[i] if sheet_ids else i)) for i, s in enumerate(sheets)]
+    stats["sheet_ids"] = np.array([sid for sid, ok in zip(ids, cohort["known"]) if ok], dtype=str)
+    stats["option_overflow"] = keys.option_overflow
+    return stats
+
+
+def main():
+    if len(sys.argv) < 4:
+        print(json.dumps({"success": False,
+                          "error": "Usage: python item_analysis.py <keys_json> <out.npz|out.json> <results_json>..."}))
+        sys.exit(1)
+
+    try:
+        keys = AnswerKeys.load(sys.argv[1])
+        sheets, labels = [], []
+        for path in sys.argv[3:]:
+            with open(path, 'r', encoding='utf-8') as f:
+                file_sheets = sheets_from(json.load(f))
+            name = os.path.basename(path)
+            labels += [name if len(file_sheets) == 1 else f"{name}#{s.get('page') or j + 1}"
+                       for j, s in enumerate(file_sheets)]
+            sheets.extend(file_sheets)
+    except (OSError, ValueError) as e:
+        print(json.dumps({"success": False, "error": str(e)}))
+        sys.exit(1)
+
+    stats = analyze_results(keys, sheets, labels)
+    export(stats, sys.argv[2])
+    print(json.dumps({"success": True, "output": sys.argv[2], "sheets": len(stats["sheet_ids"]),
+                      "items": int(len(stats["difficulty"])), "flagged_pairs": int(len(stats["pair_a"]))}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OMR load test - imtihon kuni yuklamasini mahalliy sinash
+Replays a corpus of sheet photos through the same entry points the server spawns
+(omr_hybrid.py, qr_scanner.py), one process per request as omr.routes.ts does, either
+closed-loop at a fixed concurrency or open-loop at a Poisson arrival rate. Each worker
+is reaped with wait4, so its CPU time and peak RSS are exact without polling.
+Latency counts from the scheduled arrival, i.e. includes queueing when the pool is
+saturated (open loop) — that is what a teacher uploading at 8:05 sees.
+
+Usage: python omr_loadtest.py <image|dir> [...] [--target omr|qr|both]
+                              [--concurrency N | --rate PER_SEC] [--requests N | --duration S]
+                              [--options JSON] [--output report.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = {
+    'omr': os.path.join(SCRIPT_DIR, 'omr_hybrid.py'),
+    'qr': os.path.join(SCRIPT_DIR, 'qr_scanner.py'),
+}
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+PERCENTILES = (50, 90, 95, 99)
+
+
+def load_corpus(paths):
+    """Image files from the given files / directories (sorted, non-recursive)"""
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            images.extend(os.path.join(path, f) for f in sorted(os.listdir(path))
+                          if f.lower().endswith(IMAGE_EXTS))
+        elif os.path.isfile(path):
+            images.append(path)
+    return images
+
+
+def run_worker(cmd, timeout):
+    """Run one scan process. Returns (exit code, stdout, cpu seconds, peak RSS MB);
+    cpu / RSS are None where wait4 is unavailable (Windows)."""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    killer = threading.Timer(timeout, proc.kill)
+    killer.start()
+    try:
+        stdout = proc.stdout.read()
+        proc.stdout.close()
+        if not hasattr(os, 'wait4'):
+            return proc.wait(), stdout, None, None
+        _, status, usage = os.wait4(proc.pid, 0)
+        # Same convention as Popen.returncode (-signal if killed); README says Python 3.7+
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    finally:
+        killer.cancel()
+    # ru_maxrss: KB on Linux, bytes on macOS
+    rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return proc.returncode, stdout, usage.ru_utime + usage.ru_stime, rss_mb
+
+
+def parse_output(stdout):
+    """Last JSON object on stdout (same rule as omr.routes.ts), None if unparsable"""
+    text = stdout.decode('utf-8', 'replace').strip()
+    start = text.rfind('\n{')
+    try:
+        return json.loads(text[start + 1:] if start >= 0 else text)
+    except ValueError:
+        return None
+
+
+def scan_request(image, target, python, options, timeout):
+    """One upload: QR and/or OMR process(es) in sequence, like the upload route"""
+    steps = ['qr', 'omr'] if target == 'both' else [target]
+    record = {"image": image, "ok": True, "cpu_s": 0.0, "rss_mb": 0.0, "steps": {}}
+    for step in steps:
+        cmd = [python, SCRIPTS[step], image]
+        if step == 'omr':
+            cmd += ['{}', options]
+        t0 = time.perf_counter()
+        code, stdout, cpu, rss = run_worker(cmd, timeout)
+        elapsed = time.perf_counter() - t0
+        out = parse_output(stdout)
+        ok = code == 0 and out is not None and (out.get('success', True) if step == 'omr' else True)
+        record["steps"][step] = {"latency_s": elapsed, "exit": code, "ok": ok}
+        if step == 'qr' and out is not None:
+            record["steps"][step]["found"] = bool(out.get('found'))
+        record["ok"] = record["ok"] and ok
+        if cpu is not None:
+            record["cpu_s"] += cpu
+            record["rss_mb"] = max(record["rss_mb"], rss)
+        else:
+            record["cpu_s"] = record["rss_mb"] = None
+    return record
+
+
+def run(images, target='omr', concurrency=4, rate=None, requests=None, duration=None,
+        python=sys.executable, options='{}', timeout=30.0, seed=0, progress=True):
+    """Drive the load. Closed loop (rate=None): `concurrency` requests always in flight.
+    Open loop: Poisson arrivals at `rate`/s, at most `concurrency` processes at once,
+    the rest queue. Stops after `requests` (default: one pass over the corpus) or
+    `duration` seconds of arrivals. Returns per-request records."""
+    rnd = random.Random(seed)
+    if requests is None and duration is None:
+        requests = len(images)
+    records = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def job(i, arrival):
+        rec = scan_request(images[i % len(images)], target, python, options, timeout)
+        done = time.perf_counter()
+        rec["arrival_s"] = arrival - start
+        rec["latency_s"] = done - arrival  # includes queueing behind busy workers
+        with lock:
+            records.append(rec)
+            if progress:
+                print(f"\r  {len(records)} done, last {rec['latency_s'] * 1000:.0f}ms", end='', file=sys.stderr)
+
+    def more(i, now):
+        return (requests is None or i < requests) and (duration is None or now - start < duration)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if rate is None:
+            # Closed loop: each slot submits its next request when the previous finishes
+            counter = iter(range(1 << 62))
+            counter_lock = threading.Lock()
+
+            def slot():
+                while True:
+                    with counter_lock:
+                        i = next(counter)
+                    now = time.perf_counter()
+                    if not more(i, now):
+                        return
+                    job(i, now)
+
+            for f in [pool.submit(slot) for _ in range(concurrency)]:
+                f.result()
+        else:
+            futures = []
+            i, arrival = 0, start
+            while more(i, arrival):
+                delay = arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(pool.submit(job, i, arrival))
+                i += 1
+                arrival += rnd.expovariate(rate)
+            for f in futures:
+                f.result()
+    if progress:
+        print(file=sys.stderr)
+    return records, time.perf_counter() - start
+
+
+def summarize(records, wall_s):
+    """Throughput, latency percentiles, CPU utilisation and peak RSS per worker"""
+    ok = [r for r in records if r["ok"]]
+    latency = np.array([r["latency_s"] for r in records]) * 1000
+    summary = {
+        "requests": len(records),
+        "errors": len(records) - len(ok),
+        "wall_s": round(wall_s, 2),
+        "throughput_per_s": round(len(ok) / wall_s, 3) if wall_s > 0 else 0.0,
+        "latency_ms": {f"p{p}": round(float(np.percentile(latency, p)), 1) for p in PERCENTILES}
+        if len(latency) else {},
+    }
+    if len(latency):
+        summary["latency_ms"]["max"] = round(float(latency.max()), 1)
+        summary["latency_ms"]["mean"] = round(float(latency.mean()), 1)
+
+    steps = sorted({s for r in records for s in r["steps"]})
+    summary["steps"] = {}
+    for step in steps:
+        lat = np.array([r["steps"][step]["latency_s"] for r in records if step in r["steps"]]) * 1000
+        info = {f"p{p}": round(float(np.percentile(lat, p)), 1) for p in PERCENTILES}
+        found = [r["steps"][step]["found"] for r in records if "found" in r["steps"].get(step, {})]
+        if found:
+            info["found_rate"] = round(sum(found) / len(found), 3)
+        summary["steps"][step] = info
+
+    cpu = np.array([r["cpu_s"] for r in records if r["cpu_s"] is not None])
+    rss = np.array([r["rss_mb"] for r in records if r["rss_mb"] is not None])
+    if len(cpu):
+        cores = os.cpu_count() or 1
+        summary["cpu"] = {
+            "per_request_s": round(float(cpu.mean()), 3),
+            "utilisation_pct": round(float(cpu.sum()) / (wall_s * cores) * 100, 1),  # of all cores
+            "cores": cores,
+        }
+        summary["peak_rss_mb"] = {"p50": round(float(np.percentile(rss, 50)), 1),
+                                  "max": round(float(rss.max()), 1)}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the OMR / QR scanning workers")
+    parser.add_argument('corpus', nargs='+', help="sheet images or directories of images")
+    parser.add_argument('--target', choices=['omr', 'qr', 'both'], default='omr')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="requests in flight (closed loop) / worker cap (with --rate)")
+    parser.add_argument('--rate', type=float, help="open loop: Poisson arrivals per second")
+    parser.add_argument('--requests', type=int, help="total requests (default: one pass over the corpus)")
+    parser.add_argument('--duration', type=float, help="seconds of arrivals instead of --requests")
+    parser.add_argument('--options', default='{}', help="omr_hybrid.py options JSON, e.g. '{\"totalQuestions\": 45}'")
+    parser.add_argument('--python', default=sys.executable, help="interpreter the server uses (PYTHON_PATH)")
+    parser.add_argument('--timeout', type=float, default=30.0, help="per-process timeout, as in omr.routes.ts")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write summary + per-request records as JSON")
+    args = parser.parse_args()
+
+    images = load_corpus(args.corpus)
+    if not images:
+        print(json.dumps({"success": False, "error": "No images in corpus"}))
+        sys.exit(1)
+
+    mode = f"rate={args.rate}/s" if args.rate else f"concurrency={args.concurrency}"
+    print(f"Load test: {len(images)} images, target={args.target}, {mode}", file=sys.stderr)
+    records, wall_s = run(images, args.target, args.concurrency, args.rate, args.requests,
+                          args.duration, args.python, args.options, args.timeout, args.seed)
+    summary = summarize(records, wall_s)
+    summary.update({"target": args.target, "concurrency": args.concurrency, "rate": args.rate,
+                    "corpus": len(images)})
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"summary": summary, "records": records}, f, ensure_ascii=False, indent=1)
+    print(json.dumps({"success": True, **summary}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
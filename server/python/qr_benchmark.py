@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+QR benchmark - qr_scanner kaskadi uchun aniqlik / tezlik o'lchovi
+Generated payloads in our formats ({"c": code, "q": total} from pdfGeneratorService.ts,
+plain variant codes from AnswerSheet.tsx) are rendered into the sheet header where
+pdfGeneratorService.ts puts them, pushed down / resized as taller headers and print
+scaling do (independent of the sheet_layouts.json search box, which is what is being
+tested), and "photographed" with degradations: blur, glare, perspective, low
+resolution, JPEG, upside down. Measured:
+  pipeline  scan_qr_photo end to end (default method order, no stats file):
+            decode rate, misreads, latency
+  methods   every cascade step on every image on its own: decode rate, time, peak
+            memory (tracemalloc: numpy / cv2 output arrays), first wins when the cascade
+            runs in default order, and decodes no other step gets (what removing it loses)
+
+Usage: python qr_benchmark.py [--payloads N] [--seed S] [--px-per-mm P] [--json out.json]
+"""
+
+import argparse
+import json
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from qr_scanner import (QR_METHODS, QrMethodStats, clean_qr_data, decode_codes, photo_homography,
+                        scan_qr_header, scan_qr_photo)
+from sheet_layouts import get_layout
+
+# kind -> levels (blur sigma in mm, glare peak, perspective jitter, downscale, JPEG quality)
+DEGRADATIONS = {
+    'clean': [None],
+    'blur': [0.15, 0.3],
+    'glare': [0.6, 0.9],
+    'perspective': [0.06, 0.12],
+    'lowres': [0.5, 0.3],
+    'jpeg': [30, 10],
+    'rotated': [180],
+}
+# .qr-img top-left on the page with the nominal 12mm header (pdfGeneratorService.ts CSS:
+# 10mm padding + header + 2mm margin + 1.5mm inset in the 30mm .qr-box), 27mm side
+QR_PAGE_MM = (166.5, 26.0)
+QR_SIZE_MM = 27.0
+MAX_HEADER_DROP_MM = 19.0  # image.png (printed sheet): QR 18.5mm below nominal, 25.6-29mm side
+
+
+def make_payloads(n, rnd):
+    """Variant codes, alternately as pdfGeneratorService JSON and as the plain code"""
+    payloads = []
+    for i in range(n):
+        code = ''.join(rnd.choice(string.ascii_uppercase + string.digits) for _ in range(rnd.randint(5, 9)))
+        total = rnd.choice([30, 45, 60, 90, 125])
+        payloads.append(json.dumps({"c": code, "q": total}, separators=(',', ':')) if i % 2 == 0 else code)
+    return payloads
+
+
+def render_sheet(payload, layout, px_mm, drop_mm=0.0, qr_size_mm=QR_SIZE_MM):
+    """A4 page with corner marks, header / info text, the QR box and a few bubble rows;
+    everything below the academy header moves down by drop_mm"""
+    P = lambda mm: int(round(mm * px_mm))
+    page = np.full((P(layout.page_h_mm), P(layout.page_w_mm), 3), 255, np.uint8)
+    m, s = layout.corner_offset_mm - layout.corner_mark_mm / 2, layout.corner_mark_mm
+    for x in (m, layout.page_w_mm - m - s):
+        for y in (m, layout.page_h_mm - m - s):
+            cv2.rectangle(page, (P(x), P(y)), (P(x + s) - 1, P(y + s) - 1), (0, 0, 0), -1)
+
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    cv2.putText(page, "MATH ACADEMY", (P(80), P(18)), font, px_mm * 0.08, (110, 26, 26), 2)
+    cv2.line(page, (P(15), P(22 + drop_mm)), (P(195), P(22 + drop_mm)), (50, 50, 50), max(1, P(0.5)))
+    cv2.putText(page, "JAVOB VARAQASI", (P(15), P(32 + drop_mm)), font, px_mm * 0.09, (0, 0, 0), 2)
+    for i, text in enumerate(["O'quvchi: Aliyev Vali", "Fan: Matematika", "ID: 123456", "Sinf: 7-A"]):
+        cv2.putText(page, text, (P(15), P(40 + drop_mm + 6 * i)), font, px_mm * 0.06, (0, 0, 0), 1)
+
+    # QR box (2px border, 1.5mm around the code), level H like QRCode.toDataURL; the
+    # module count is whatever the payload needs
+    qx, qy = QR_PAGE_MM[0], QR_PAGE_MM[1] + drop_mm
+    pad = 1.5
+    cv2.rectangle(page, (P(qx - pad), P(qy - pad)), (P(qx + qr_size_mm + pad), P(qy + qr_size_mm + pad)),
+                  (0, 0, 0), 2)
+    params = cv2.QRCodeEncoder_Params()
+    params.correction_level = cv2.QRCodeEncoder_CORRECT_LEVEL_H
+    code = cv2.QRCodeEncoder.create(params).encode(payload)
+    code = cv2.resize(code, (P(qr_size_mm), P(qr_size_mm)), interpolation=cv2.INTER_NEAREST)
+    page[P(qy):P(qy) + code.shape[0], P(qx):P(qx) + code.shape[1]] = code[:, :, None]
+
+    for row in range(6):
+        for col in range(3):
+            for b in range(4):
+                center = (P(25 + col * 60 + b * 10), P(85 + drop_mm + row * 10))
+                cv2.circle(page, center, P(3.7), (0, 0, 0), max(1, P(0.25)))
+    return page
+
+
+def photograph(page, kind, level, rnd, px_mm):
+    """Page -> phone-like photo: placed on a desk with mild keystone, light and sensor
+    noise, then the degradation."""
+    h, w = page.shape[:2]
+    jitter = level if kind == 'perspective' else 0.01
+    W, H = int(w * 1.15), int(h * 1.12)
+    j = lambda: rnd.uniform(-jitter, jitter)
+    dst = np.float32([[W * (0.06 + j()), H * (0.05 + j())], [W * (0.94 + j()), H * (0.05 + j())],
+                      [W * (0.94 + j()), H * (0.95 + j())], [W * (0.06 + j()), H * (0.95 + j())]])
+    src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    photo = cv2.warpPerspective(page, cv2.getPerspectiveTransform(src, dst), (W, H), borderValue=(190, 185, 180))
+    photo = photo.astype(np.float32) * rnd.uniform(0.8, 1.0)
+    photo += np.random.default_rng(rnd.randrange(1 << 30)).normal(0, 3, photo.shape)
+
+    if kind == 'glare':
+        # Bright elliptical reflection over the header, saturating
+        cx, cy = W * rnd.uniform(0.7, 0.85), H * rnd.uniform(0.1, 0.18)
+        yy, xx = np.mgrid[0:H, 0:W].astype(np.float32)
+        blob = np.exp(-(((xx - cx) / (W * 0.12)) ** 2 + ((yy - cy) / (H * 0.06)) ** 2))
+        photo += (255 - photo) * (level * blob)[:, :, None]
+    photo = np.clip(photo, 0, 255).astype(np.uint8)
+
+    if kind == 'blur':
+        photo = cv2.GaussianBlur(photo, (0, 0), level * px_mm)
+    elif kind == 'lowres':
+        photo = cv2.resize(photo, None, fx=level, fy=level, interpolation=cv2.INTER_AREA)
+    elif kind == 'jpeg':
+        photo = cv2.imdecode(cv2.imencode('.jpg', photo, [cv2.IMWRITE_JPEG_QUALITY, level])[1], cv2.IMREAD_COLOR)
+    elif kind == 'rotated':
+        photo = cv2.rotate(photo, cv2.ROTATE_180)
+    return photo
+
+
+def build_corpus(n_payloads, seed, px_mm):
+    """[(kind, level, expected cleaned data, photo)]"""
+    rnd = random.Random(seed)
+    layout = get_layout(45)
+    corpus = []
+    for payload in make_payloads(n_payloads, rnd):
+        page = render_sheet(payload, layout, px_mm, drop_mm=rnd.uniform(0, MAX_HEADER_DROP_MM),
+                            qr_size_mm=rnd.uniform(25.5, 29.0))
+        for kind, levels in DEGRADATIONS.items():
+            for level in levels:
+                corpus.append((kind, level, clean_qr_data(payload), photograph(page, kind, level, rnd, px_mm)))
+    return corpus
+
+
+def measure(fn):
+    """(result, seconds, peak MB of traced allocations)"""
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        result = fn()
+    finally:
+        seconds = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, seconds, peak / 2 ** 20
+
+
+def run_method(name, img, layout, detector):
+    """Codes decoded by one cascade step alone ('header' = layout ROI incl. corner search)"""
+    if name == 'header':
+        return scan_qr_header(img, photo_homography(img, layout), layout).get('codes', [])
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    for candidate, to_image in QR_METHODS[name](img, gray, detector):
+        codes = decode_codes(detector, candidate, to_image, multi=(name == 'multi'))
+        if codes:
+            return codes
+    return []
+
+
+def run(corpus, progress=True):
+    """Per-image records: pipeline outcome and every method's outcome"""
+    layout = get_layout(45)
+    detector = cv2.QRCodeDetector()
+    methods = ['header'] + list(QR_METHODS)
+    for name in methods:  # warm-up: first-call initialisation must not count as cost
+        run_method(name, corpus[0][3], layout, detector)
+    records = []
+    for i, (kind, level, expected, img) in enumerate(corpus):
+        result, seconds, peak = measure(lambda: scan_qr_photo(img, stats=QrMethodStats(None)))
+        rec = {"kind": kind, "level": level, "pixels": int(img.shape[0] * img.shape[1]),
+               "pipeline": {"ok": result.get('data') == expected,
+                            "misread": bool(result.get('found')) and result.get('data') != expected,
+                            "ms": seconds * 1000, "peak_mb": peak,
+                            "method": result.get('method'), "attempts": result.get('attempts', 0)},
+               "methods": {}}
+        for name in methods:
+            codes, seconds, peak = measure(lambda: run_method(name, img, layout, detector))
+            rec["methods"][name] = {"ok": any(c['data'] == expected for c in codes),
+                                    "ms": seconds * 1000, "peak_mb": peak}
+        records.append(rec)
+        if progress:
+            print(f"\r  {i + 1}/{len(corpus)} images", end='', file=sys.stderr)
+    if progress:
+        print(file=sys.stderr)
+    return records
+
+
+def summarize(records):
+    """Method table (cost vs benefit) and decode rate per degradation"""
+    methods = list(records[0]["methods"])
+    kinds = list(dict.fromkeys(r["kind"] for r in records))
+    n = len(records)
+    first_win = dict.fromkeys(methods, 0)
+    only = dict.fromkeys(methods, 0)
+    for r in records:
+        wins = [m for m in methods if r["methods"][m]["ok"]]
+        if wins:
+            first_win[wins[0]] += 1  # where the default-order cascade stops
+        if len(wins) == 1:
+            only[wins[0]] += 1
+
+    rows = []
+    for m in methods + ['pipeline']:
+        cells = [r["pipeline"] if m == 'pipeline' else r["methods"][m] for r in records]
+        ms = np.array([c["ms"] for c in cells])
+        row = {"method": m,
+               "decode_pct": 100.0 * sum(c["ok"] for c in cells) / n,
+               "mean_ms": float(ms.mean()), "p95_ms": float(np.percentile(ms, 95)),
+               "peak_mb": float(max(c["peak_mb"] for c in cells)),
+               "by_kind": {k: 100.0 * np.mean([c["ok"] for c, r in zip(cells, records) if r["kind"] == k])
+                           for k in kinds}}
+        if m == 'pipeline':
+            row["misreads"] = sum(c["misread"] for c in cells)
+            row["mean_attempts"] = float(np.mean([c["attempts"] for c in cells]))
+        else:
+            row["first_wins"] = first_win[m]
+            row["only"] = only[m]
+            row["ms_per_decode"] = float(ms.sum() / max(1, sum(c["ok"] for c in cells)))
+        rows.append(row)
+    return {"images": n, "kinds": kinds, "rows": rows}
+
+
+def print_tables(summary, out=sys.stdout):
+    rows, kinds = summary["rows"], summary["kinds"]
+    out.write(f"\nQR benchmark: {summary['images']} images\n\n")
+    out.write(f"{'method':<10} {'decode%':>8} {'1st-win':>8} {'only':>5} {'mean ms':>8} {'p95 ms':>8} "
+              f"{'ms/decode':>10} {'peak MB':>8}\n")
+    for r in rows:
+        if r["method"] == 'pipeline':
+            out.write(f"{'pipeline':<10} {r['decode_pct']:>7.1f}% {'':>8} {'':>5} {r['mean_ms']:>8.1f} "
+                      f"{r['p95_ms']:>8.1f} {'':>10} {r['peak_mb']:>8.1f}   "
+                      f"misreads={r['misreads']} attempts={r['mean_attempts']:.1f}\n")
+        else:
+            out.write(f"{r['method']:<10} {r['decode_pct']:>7.1f}% {r['first_wins']:>8} {r['only']:>5} "
+                      f"{r['mean_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['ms_per_decode']:>10.1f} {r['peak_mb']:>8.1f}\n")
+    out.write("\ndecode % by degradation\n")
+    out.write(f"{'method':<10} " + " ".join(f"{k:>11}" for k in kinds) + "\n")
+    for r in rows:
+        out.write(f"{r['method']:<10} " + " ".join(f"{r['by_kind'][k]:>10.0f}%" for k in kinds) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QR decoding benchmark for qr_scanner.py")
+    parser.add_argument('--payloads', type=int, default=4, help="payloads (each rendered under every degradation)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--px-per-mm', type=float, default=6.0, help="page render resolution (6 ~ 1.9 MP photo)")
+    parser.add_argument('--json', help="also write summary + per-image records as JSON")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.payloads, args.seed, args.px_per_mm)
+    print(f"Corpus: {len(corpus)} images ({args.payloads} payloads x "
+          f"{sum(len(v) for v in DEGRADATIONS.values())} conditions)", file=sys.stderr)
+    records = run(corpus)
+    summary = summarize(records)
+    print_tables(summary)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"summary": summary, "records": records}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
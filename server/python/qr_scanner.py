@@ -1,110 +1,412 @@
 #!/usr/bin/env python3
 """
 QR Code Scanner for OMR Answer Sheets
-Supports multiple detection methods for robust QR code reading
+Looks in the expected header region first (sheet layout + corner marks, resampled to
+a fixed module size); the full-frame multi-method cascade runs only if that fails.
+Every decoded code is returned with its corner points (image px), module size, and
+the sheet rotation implied by the code's orientation (QR is printed upright).
+
+Usage: python qr_scanner.py <image_path>
+       python qr_scanner.py --batch [--workers N] <image_path> [image_path ...]
+           process pool, one JSON line per image as it completes
+       python qr_scanner.py --worker
+           persistent: one request per stdin line ({"id": ..., "path": ..., "sheetVersion": ...}
+           or a bare path), one JSON line per request on stdout
+Method statistics (QR_STATS_PATH) order the cascade in every mode, but only --batch
+and --worker write them back: one-shot calls run once per upload, concurrently, and
+would race on the file.
 """
         
 import cv2
 import json
+import os
 import sys
+import time
 import numpy as np
 
-def scan_qr_code(image_path):
+from sheet_layouts import get_layout
+
+QR_PX_PER_MODULE = 6  # detectAndDecode is most reliable at ~4-8 px per module
+CORNER_SEARCH_W = 1000  # corner marks located on a downscaled copy (mm-level accuracy is enough)
+SCALE_BUDGET_PX = 4_000_000  # max pixels of any rescaled image in the cascade (gray, 4 MB)
+# Which cascade method wins on our uploads (QR_STATS_PATH overrides, e.g. a writable data
+# directory; "" disables). Saved by --batch / --worker only, read by every scan
+STATS_PATH = os.environ.get('QR_STATS_PATH',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qr_method_stats.json'))
+
+def scan_qr_code(image_path, sheet_version=None, stats=None):
+    """
+    Scan QR code from image: header region first, then the whole frame.
+    stats: shared QrMethodStats (caller saves); by default a read-only snapshot of
+    STATS_PATH, used for ordering and never written back
+    Returns: dict with 'found' (bool) and 'data' (str, first code) keys, plus 'codes'
+    and 'orientation' (see decode_codes / code_orientation)
+    """
+    # Read image
+    img = cv2.imread(image_path)
+    if img is None:
+        return {'found': False, 'error': 'Failed to read image'}
+    return scan_qr_photo(img, sheet_version, stats)
+
+def scan_qr_photo(img, sheet_version=None, stats=None):
+    """scan_qr_code on an already loaded BGR photo"""
+    if stats is None:
+        stats = QrMethodStats(STATS_PATH)
+    t0 = time.perf_counter()
+    try:
+        layout = get_layout(45, sheet_version)  # page / QR geometry is the same for every question count
+        result = scan_qr_header(img, photo_homography(img, layout), layout)
+    except Exception as e:
+        # Unknown sheet version, corner search / ROI failure: the full-frame cascade still runs
+        result = {'found': False, 'error': f'Header scan failed: {e}'}
+    stats.record('header', time.perf_counter() - t0, result.get('found', False))
+    if not result.get('found'):
+        header_attempts = result.get('attempts', 0)
+        result = scan_qr_image(img, stats)
+        result['attempts'] = result.get('attempts', 0) + header_attempts
+    return result
+
+def clean_qr_data(data):
+    """Clean and normalize QR code data"""
+    if not data:
+        return None
+    # Remove whitespace and convert to uppercase
+    cleaned = data.strip().upper()
+    # Remove any non-alphanumeric characters except hyphens
+    cleaned = ''.join(c for c in cleaned if c.isalnum() or c == '-')
+    return cleaned if cleaned else None
+
+def decode_codes(detector, candidate, to_image=None, multi=False):
+    """
+    Decode the QR code(s) in one candidate image. detectAndDecode first (the cascade's
+    workhorse); on success detectAndDecodeMulti picks up any further codes. multi=True
+    goes straight to detectAndDecodeMulti (several sheets / codes in one photo).
+    to_image: 3x3 candidate px -> source image px (crops, rescales), None = identity.
+    Returns: [{'data' (clean_qr_data), 'raw', 'points' (4x [x, y], from the code's top-left finder, clockwise),
+    'modules', 'module_px'}], empty if nothing decoded
+    """
+    found = []
+    if not multi:
+        data, points, straight = detector.detectAndDecode(candidate)
+        if clean_qr_data(data) and points is not None:
+            found.append((data, points, straight))
+    if multi or found:
+        ok, datas, points, straights = detector.detectAndDecodeMulti(candidate)
+        if ok and points is not None:
+            straights = straights if straights is not None else [None] * len(datas)
+            found += list(zip(datas, points, straights))
+
+    codes = []
+    for data, pts, straight in found:
+        cleaned = clean_qr_data(data)
+        if not cleaned or any(c['data'] == cleaned for c in codes):
+            continue
+        pts = np.asarray(pts, dtype=np.float32).reshape(-1, 1, 2)
+        if to_image is not None:
+            pts = cv2.perspectiveTransform(pts, np.asarray(to_image, dtype=np.float64))
+        pts = pts.reshape(-1, 2).astype(np.float64)
+        # raw: decoded text before cleaning — the {"c", "q"} JSON payload survives only here
+        code = {'data': cleaned, 'raw': data, 'points': np.round(pts, 1).tolist()}
+        # straight_qrcode is the rectified code at 1 px per module
+        if straight is not None and getattr(straight, 'size', 0):
+            side = float(np.mean(np.linalg.norm(pts - np.roll(pts, -1, axis=0), axis=1)))
+            code['modules'] = int(straight.shape[0])
+            code['module_px'] = round(side / straight.shape[0], 2)
+        codes.append(code)
+    return codes
+
+def code_orientation(points):
+    """
+    Sheet rotation implied by a code's corners (the QR is printed upright): angle of the
+    top-left -> top-right edge in image coordinates (y down), so clockwise is positive.
+    Returns: {'rotation': 0/90/180/270 (clockwise), 'angle': exact degrees}
     """
-    Scan QR code from image using multiple methods
+    (x0, y0), (x1, y1) = points[0], points[1]
+    angle = float(np.degrees(np.arctan2(y1 - y0, x1 - x0))) % 360
+    return {'rotation': int(round(angle / 90.0)) % 4 * 90, 'angle': round(angle, 1)}
+
+def _found(codes, method, attempts):
+    """Result dict for decoded codes"""
+    return {'found': True, 'data': codes[0]['data'], 'raw': codes[0]['raw'], 'method': method, 'attempts': attempts,
+            'codes': codes, 'orientation': code_orientation(codes[0]['points'])}
+
+def photo_homography(img, layout):
+    """Warped-mm -> photo px mapping (3x3). From the corner marks when they are found,
+    otherwise assume the page fills the frame (close-up phone shot)."""
+    from omr_hybrid import HybridOMR
+    h, w = img.shape[:2]
+    scale = min(1.0, CORNER_SEARCH_W / w)
+    small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else img
+    corners = HybridOMR(quality_check=False).find_corner_marks(small)
+    if corners:
+        names = ('top_left', 'top_right', 'bottom_right', 'bottom_left')
+        src = np.float32([[0, 0], [layout.span_w_mm, 0], [layout.span_w_mm, layout.span_h_mm],
+                          [0, layout.span_h_mm]])
+        dst = np.float32([[corners[n]['x'] / scale, corners[n]['y'] / scale] for n in names])
+        return cv2.getPerspectiveTransform(src, dst)
+    sx, sy = w / layout.page_w_mm, h / layout.page_h_mm
+    return np.array([[sx, 0, layout.corner_offset_mm * sx],
+                     [0, sy, layout.corner_offset_mm * sy],
+                     [0, 0, 1]], dtype=np.float64)
+
+def scan_qr_header(img, mm_to_px, layout):
+    """
+    Decode the QR from its expected box only: the layout's search box (warped mm) is
+    resampled through mm_to_px (warped mm -> image px) so one module of the densest code
+    we print is QR_PX_PER_MODULE px (sparser codes get more), then gray / Otsu are tried
+    on that small crop.
     Returns: dict with 'found' (bool) and 'data' (str) keys
     """
+    box = layout.qr_search_box_mm()
+    if box is None:
+        return {'found': False, 'error': 'No QR geometry in sheet layout'}
+    x0, y0, x1, y1 = box
+    px_per_mm = QR_PX_PER_MODULE * layout.qr_max_modules / layout.qr_size_mm
+    size = (int(round((x1 - x0) * px_per_mm)), int(round((y1 - y0) * px_per_mm)))
+    # ROI px -> warped mm -> image px
+    roi_to_mm = np.array([[1 / px_per_mm, 0, x0], [0, 1 / px_per_mm, y0], [0, 0, 1]])
+    M = mm_to_px @ roi_to_mm
+    roi = cv2.warpPerspective(img, M, size, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_REPLICATE)
+    gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY) if roi.ndim == 3 else roi
+    detector = cv2.QRCodeDetector()
+    attempts = 0
+    try:
+        for candidate in (gray, cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]):
+            attempts += 1
+            codes = decode_codes(detector, candidate, M)
+            if codes:
+                return _found(codes, 'header', attempts)
+    except cv2.error as e:
+        return {'found': False, 'error': str(e), 'attempts': attempts}
+    return {'found': False, 'error': 'QR code not detected in header region', 'attempts': attempts}
+
+# Cascade methods yield (candidate image, candidate px -> source px 3x3 or None)
+
+def _method_original(img, gray, detector):
+    yield img, None
+
+def _method_gray(img, gray, detector):
+    yield gray, None
+
+def _method_clahe(img, gray, detector):
+    # CLAHE (Contrast Limited Adaptive Histogram Equalization)
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    yield clahe.apply(gray), None
+
+def _method_binary(img, gray, detector):
+    yield cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)[1], None
+
+def _method_adaptive(img, gray, detector):
+    yield cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2), None
+
+def _method_otsu(img, gray, detector):
+    yield cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1], None
+
+def _method_scale(img, gray, detector):
+    # Grayscale pyramid within SCALE_BUDGET_PX: 0.5x is one pyrDown level; upscaling
+    # only the candidate region from detect()
+    small = cv2.pyrDown(gray)
+    yield small, np.diag([gray.shape[1] / small.shape[1], gray.shape[0] / small.shape[0], 1.0])
+    region, (rx, ry) = _qr_candidate_region(detector, gray, small)
+    for scale in [1.5, 2.0]:
+        h, w = region.shape[:2]
+        scale = min(scale, np.sqrt(SCALE_BUDGET_PX / float(w * h)))
+        if scale <= 1.0:
+            break
+        size = (int(w * scale), int(h * scale))
+        to_image = np.array([[w / size[0], 0, rx], [0, h / size[1], ry], [0, 0, 1.0]])
+        yield cv2.resize(region, size, interpolation=cv2.INTER_LINEAR), to_image
+
+def _method_multi(img, gray, detector):
+    # Several codes in one photo (stack of sheets): detectAndDecodeMulti on gray
+    yield gray, None
+
+# Cascade methods in their default (cold-start) order; each yields candidate images
+QR_METHODS = {
+    'original': _method_original,
+    'gray': _method_gray,
+    'clahe': _method_clahe,
+    'binary': _method_binary,
+    'adaptive': _method_adaptive,
+    'otsu': _method_otsu,
+    'scale': _method_scale,
+    'multi': _method_multi,
+}
+
+class QrMethodStats:
+    """Per-method success / cost counters, persisted as a small JSON file
+    ({"clahe": {"tries": n, "wins": n, "seconds": s}, ...}). The cascade is ordered by
+    smoothed success rate per second. Concurrent workers may drop an update now and
+    then (last writer wins) — fine for statistics."""
+
+    PRIOR_SECONDS = 0.05  # assumed cost of a method not tried yet
+
+    def __init__(self, path=None):
+        self.path = path
+        self.counts = {}
+        self.events = []  # (name, seconds, won) recorded by this instance, for merging
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.counts = json.load(f)
+            except (OSError, ValueError):
+                self.counts = {}
+
+    def order(self):
+        """Cascade method names, best success-per-second first (ties: default order)"""
+        def rate(name):
+            c = self.counts.get(name, {})
+            tries = c.get('tries', 0)
+            success = (c.get('wins', 0) + 1) / (tries + 2)  # Laplace smoothing
+            cost = c.get('seconds', 0.0) / tries if tries else self.PRIOR_SECONDS
+            return success / max(cost, 1e-4)
+        names = list(QR_METHODS)
+        return sorted(names, key=lambda n: (-rate(n), names.index(n)))
+
+    def record(self, name, seconds, won):
+        c = self.counts.setdefault(name, {'tries': 0, 'wins': 0, 'seconds': 0.0})
+        c['tries'] += 1
+        c['wins'] += int(won)
+        c['seconds'] = round(c['seconds'] + seconds, 6)
+        self.events.append((name, seconds, bool(won)))
+
+    def merge(self, events):
+        """Apply events recorded by another instance (e.g. a batch worker process)"""
+        for name, seconds, won in events:
+            self.record(name, seconds, won)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.counts, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)  # atomic: readers never see a partial file
+        except OSError as e:
+            print(f"QR stats not saved ({self.path}): {e}", file=sys.stderr)
+
+def scan_qr_image(img, stats=None):
+    """
+    Scan QR code from an already loaded BGR image (e.g. a warped sheet header crop)
+    with the multi-method cascade; ordered and updated by stats (QrMethodStats) if given
+    Returns: dict with 'found' (bool) and 'data' (str) keys, plus 'method' (the winner),
+    'attempts' (candidate images decoded), 'codes' and 'orientation'
+    (see decode_codes / code_orientation)
+    """
+    attempts = 0
     try:
-        # Read image
-        img = cv2.imread(image_path)
-        if img is None:
-            return {'found': False, 'error': 'Failed to read image'}
-        
         # Initialize QR detector
         detector = cv2.QRCodeDetector()
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
         
-        def clean_qr_data(data):
-            """Clean and normalize QR code data"""
-            if not data:
-                return None
-            # Remove whitespace and convert to uppercase
-            cleaned = data.strip().upper()
-            # Remove any non-alphanumeric characters except hyphens
-            cleaned = ''.join(c for c in cleaned if c.isalnum() or c == '-')
-            return cleaned if cleaned else None
-        
-        # Method 1: Original image
-        data, bbox, _ = detector.detectAndDecode(img)
-        if data:
-            cleaned = clean_qr_data(data)
-            if cleaned:
-                return {'found': True, 'data': cleaned}
-        
-        # Method 2: Grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        data, bbox, _ = detector.detectAndDecode(gray)
-        if data:
-            cleaned = clean_qr_data(data)
-            if cleaned:
-                return {'found': True, 'data': cleaned}
-        
-        # Method 3: CLAHE (Contrast Limited Adaptive Histogram Equalization)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        enhanced = clahe.apply(gray)
-        data, bbox, _ = detector.detectAndDecode(enhanced)
-        if data:
-            cleaned = clean_qr_data(data)
-            if cleaned:
-                return {'found': True, 'data': cleaned}
+        for name in (stats.order() if stats else QR_METHODS):
+            t0 = time.perf_counter()
+            for candidate, to_image in QR_METHODS[name](img, gray, detector):
+                attempts += 1
+                codes = decode_codes(detector, candidate, to_image, multi=(name == 'multi'))
+                if codes:
+                    if stats:
+                        stats.record(name, time.perf_counter() - t0, True)
+                    return _found(codes, name, attempts)
+            if stats:
+                stats.record(name, time.perf_counter() - t0, False)
         
-        # Method 4: Binary threshold
-        _, binary = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
-        data, bbox, _ = detector.detectAndDecode(binary)
-        if data:
-            cleaned = clean_qr_data(data)
-            if cleaned:
-                return {'found': True, 'data': cleaned}
-        
-        # Method 5: Adaptive threshold
-        adaptive = cv2.adaptiveThreshold(
-            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY, 11, 2
-        )
-        data, bbox, _ = detector.detectAndDecode(adaptive)
-        if data:
-            cleaned = clean_qr_data(data)
-            if cleaned:
-                return {'found': True, 'data': cleaned}
-        
-        # Method 6: Otsu's threshold
-        _, otsu = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        data, bbox, _ = detector.detectAndDecode(otsu)
-        if data:
-            cleaned = clean_qr_data(data)
-            if cleaned:
-                return {'found': True, 'data': cleaned}
-        
-        # Method 7: Try with different scales
-        for scale in [0.5, 1.5, 2.0]:
-            width = int(img.shape[1] * scale)
-            height = int(img.shape[0] * scale)
-            resized = cv2.resize(img, (width, height), interpolation=cv2.INTER_LINEAR)
-            data, bbox, _ = detector.detectAndDecode(resized)
-            if data:
-                cleaned = clean_qr_data(data)
-                if cleaned:
-                    return {'found': True, 'data': cleaned}
-        
-        return {'found': False, 'error': 'QR code not detected'}
+        return {'found': False, 'error': 'QR code not detected', 'attempts': attempts}
         
     except Exception as e:
-        return {'found': False, 'error': str(e)}
+        return {'found': False, 'error': str(e), 'attempts': attempts}
+
+def _qr_candidate_region(detector, gray, small):
+    """Crop of gray around the QR that detect() locates (full size, then the pyrDown
+    level), with a quiet-zone margin; the whole gray image if nothing is located.
+    Returns (crop, (x0, y0) offset in gray)."""
+    for level, search in ((1, gray), (2, small)):
+        ok, points = detector.detect(search)
+        if ok and points is not None:
+            pts = points.reshape(-1, 2) * level
+            x0, y0 = pts.min(axis=0)
+            x1, y1 = pts.max(axis=0)
+            pad = 0.25 * max(x1 - x0, y1 - y0)  # quiet zone + detect() corner error
+            h, w = gray.shape[:2]
+            x0, y0 = int(max(0, x0 - pad)), int(max(0, y0 - pad))
+            x1, y1 = int(min(w, x1 + pad)), int(min(h, y1 + pad))
+            if x1 - x0 >= 8 and y1 - y0 >= 8:
+                return gray[y0:y1, x0:x1], (x0, y0)
+    return gray, (0, 0)
+
+_worker_stats = None
+
+def _batch_init(stats_path):
+    """Pool initializer: one stats snapshot per worker process, for method ordering"""
+    global _worker_stats
+    _worker_stats = QrMethodStats(stats_path)
+
+def _batch_scan(image_path, sheet_version):
+    """-> (path, result, stats events of this scan); the parent merges and saves the events"""
+    start = len(_worker_stats.events)
+    try:
+        result = scan_qr_code(image_path, sheet_version, _worker_stats)
+    except Exception as e:
+        result = {'found': False, 'error': str(e)}
+    return image_path, result, _worker_stats.events[start:]
+
+def run_batch(paths, workers=None, sheet_version=None, out=sys.stdout):
+    """Scan many images in a process pool; one JSON line per image, in completion order"""
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    stats = QrMethodStats(STATS_PATH)
+    workers = workers or min(len(paths), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_batch_init, initargs=(STATS_PATH,)) as pool:
+        futures = [pool.submit(_batch_scan, p, sheet_version) for p in paths]
+        for future in as_completed(futures):
+            image_path, result, events = future.result()
+            stats.merge(events)
+            out.write(json.dumps({'path': image_path, **result}, ensure_ascii=False) + '\n')
+            out.flush()
+    stats.save()
+
+def run_worker(inp=sys.stdin, out=sys.stdout):
+    """Persistent worker: cv2 and the stats are loaded once, then one request per line"""
+    stats = QrMethodStats(STATS_PATH)
+    for line in inp:
+        line = line.strip()
+        if not line:
+            continue
+        request_id = None
+        try:
+            request = json.loads(line) if line.startswith('{') else {'path': line}
+            request_id = request.get('id')
+            result = scan_qr_code(request['path'], request.get('sheetVersion'), stats)
+            stats.save()
+        except (KeyError, ValueError) as e:
+            result = {'found': False, 'error': f'Bad request: {e}'}
+        except Exception as e:
+            result = {'found': False, 'error': str(e)}
+        out.write(json.dumps({'id': request_id, **result}, ensure_ascii=False) + '\n')
+        out.flush()
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print(json.dumps({'found': False, 'error': 'No image path provided'}))
         sys.exit(1)
     
+    if sys.argv[1] == '--worker':
+        run_worker()
+        sys.exit(0)
+    
+    if sys.argv[1] == '--batch':
+        args = sys.argv[2:]
+        workers = None
+        if args[:1] == ['--workers'] and len(args) >= 2:
+            workers = int(args[1])
+            args = args[2:]
+        if not args:
+            print(json.dumps({'found': False, 'error': 'No image path provided'}))
+            sys.exit(1)
+        run_batch(args, workers)
+        sys.exit(0)
+    
     image_path = sys.argv[1]
     result = scan_qr_code(image_path)
     
@@ -113,6 +415,7 @@ if __name__ == '__main__':
         print(f"DEBUG: QR Code found: '{result['data']}'", file=sys.stderr)
         print(f"DEBUG: QR Code length: {len(result['data'])}", file=sys.stderr)
         print(f"DEBUG: QR Code bytes: {result['data'].encode('utf-8').hex()}", file=sys.stderr)
+        print(f"DEBUG: QR method: {result.get('method')} ({result.get('attempts')} attempts)", file=sys.stderr)
     else:
         print(f"DEBUG: QR Code not found: {result.get('error', 'Unknown error')}", file=sys.stderr)
     
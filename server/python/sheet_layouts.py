@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sheet layout registry - javob varaqasi geometriyasi bitta joyda
+Templates live in sheet_layouts.json, versioned and keyed by question count, and
+must match AnswerSheet.tsx / pdfGeneratorService.ts. A version may "extend" another
+and override its keys (e.g. add a bubble-coded student ID block). Each layout is
+compiled once per process; pixel templates are cached per pixel size.
+"""
+
+import json
+import os
+from functools import lru_cache
+
+import numpy as np
+
+LAYOUTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sheet_layouts.json')
+
+
+class SheetLayout:
+    """Compiled layout: page + grid geometry in mm for one (version, question count)."""
+
+    def __init__(self, version, page, spec, total, student_id=None):
+        self.version = version
+        self.total = total
+
+        # Page: A4, corner marks at corner_margin from the edge
+        self.page_w_mm = float(page['width_mm'])
+        self.page_h_mm = float(page['height_mm'])
+        self.corner_mark_mm = float(page['corner_mark_mm'])
+        self.corner_offset_mm = page['corner_margin_mm'] + self.corner_mark_mm / 2  # mark center
+        # Warped image spans corner-mark center to center (198 x 285mm for A4)
+        self.span_w_mm = self.page_w_mm - 2 * self.corner_offset_mm
+        self.span_h_mm = self.page_h_mm - 2 * self.corner_offset_mm
+        self.padding_mm = float(page['padding_mm'])
+        self.grid_pad_mm = float(page['grid_padding_mm'])
+        self.header_row_mm = float(page['header_row_mm'])
+        self.timing_mark_area_mm = float(page['timing_mark_area_mm'])
+
+        # QR code (.qr-img): nominal top-left corner / side on the page as pdfGeneratorService
+        # lays it out, the densest code we print (the module count follows the payload:
+        # 21 for a plain variant code, 29-33 for the {"c", "q"} JSON at level H) and search
+        # margins. The header only grows downwards (logo, info rows, browser print scaling):
+        # the repo's sample photo has the QR ~18mm below nominal, hence the bottom margin.
+        qr = page.get('qr')
+        self.qr_size_mm = float(qr['size_mm']) if qr else 0.0
+        if qr:
+            self.qr_max_modules = int(qr['max_modules'])
+            self.qr_x_mm = qr['x_mm'] - self.corner_offset_mm  # warped coordinates
+            self.qr_y_mm = qr['y_mm'] - self.corner_offset_mm
+            self.qr_margin_mm = (float(qr['margin_x_mm']), float(qr['margin_top_mm']),
+                                 float(qr['margin_bottom_mm']))
+
+        # Answer grid
+        self.n_cols = int(spec['columns'])
+        self.bubble_mm = float(spec['bubble_mm'])
+        self.gap_mm = float(spec['gap_mm'])
+        self.row_margin_mm = float(spec['row_margin_mm'])
+        self.col_gap_mm = float(spec['col_gap_mm'])
+        self.num_w_mm = float(spec['number_width_mm'])
+        self.rows_per_col = (total + self.n_cols - 1) // self.n_cols
+        self.row_height_mm = self.bubble_mm + 2 * self.row_margin_mm
+
+        grid_left_page_mm = self.padding_mm + self.grid_pad_mm
+        grid_right_page_mm = self.page_w_mm - self.padding_mm - self.grid_pad_mm
+        self.grid_width_mm = grid_right_page_mm - grid_left_page_mm
+        self.col_width_mm = (self.grid_width_mm - (self.n_cols - 1) * self.col_gap_mm) / self.n_cols
+        self.grid_left_mm = grid_left_page_mm - self.corner_offset_mm  # warped coordinates
+
+        # Optional student ID block: `digits` columns of bubbles 0-9 (top to bottom);
+        # x_mm/y_mm = page position of the first column's "0" bubble center
+        self.id_digits = int(student_id['digits']) if student_id else 0
+        if student_id:
+            self.id_bubble_mm = float(student_id['bubble_mm'])
+            self.id_x_mm = student_id['x_mm'] - self.corner_offset_mm  # warped coordinates
+            self.id_y_mm = student_id['y_mm'] - self.corner_offset_mm
+            self.id_pitch_x_mm = float(student_id['pitch_x_mm'])
+            self.id_pitch_y_mm = float(student_id['pitch_y_mm'])
+
+    @property
+    def params(self):
+        """(n_cols, bubble_mm, gap_mm, row_margin_mm, col_gap_mm, num_w_mm)"""
+        return (self.n_cols, self.bubble_mm, self.gap_mm, self.row_margin_mm,
+                self.col_gap_mm, self.num_w_mm)
+
+    def px_per_mm(self, w_img, h_img):
+        """Scale of a warped (corner-mark-registered) image"""
+        return w_img / self.span_w_mm, h_img / self.span_h_mm
+
+    def id_centers_mm(self):
+        """Student ID bubble centers in warped mm, (digits * 10, 2) ordered column by
+        column, digit 0-9 within a column. Empty if the layout has no ID block."""
+        if not self.id_digits:
+            return np.zeros((0, 2))
+        col, digit = np.divmod(np.arange(self.id_digits * 10), 10)
+        return np.stack([self.id_x_mm + col * self.id_pitch_x_mm,
+                         self.id_y_mm + digit * self.id_pitch_y_mm], axis=1)
+
+    def qr_search_box_mm(self):
+        """(x0, y0, x1, y1) warped mm around the QR code, clipped to the mark span;
+        None if the layout has no QR geometry."""
+        if not self.qr_size_mm:
+            return None
+        mx, top, bottom = self.qr_margin_mm
+        return (max(0.0, self.qr_x_mm - mx), max(0.0, self.qr_y_mm - top),
+                min(self.span_w_mm, self.qr_x_mm + self.qr_size_mm + mx),
+                min(self.span_h_mm, self.qr_y_mm + self.qr_size_mm + bottom))
+
+    def __repr__(self):
+        return f"SheetLayout({self.version}, {self.total}q, {self.n_cols}x{self.rows_per_col})"
+
+
+@lru_cache(maxsize=1)
+def _registry():
+    with open(LAYOUTS_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def versions():
+    """Known sheet versions"""
+    return sorted(_registry()['versions'].keys())
+
+
+def _version_entry(version):
+    """Version dict with "extends" resolved (own keys override the base's)"""
+    entries = _registry()['versions']
+    entry = entries[version]
+    if 'extends' in entry:
+        entry = {**_version_entry(entry['extends']), **entry}
+        del entry['extends']
+    return entry
+
+
+@lru_cache(maxsize=None)
+def get_layout(total, version=None):
+    """Compiled layout for a sheet with `total` questions. Raises ValueError for an
+    unknown version."""
+    registry = _registry()
+    version = version or registry['default_version']
+    if version not in registry['versions']:
+        raise ValueError(f"Unknown sheet version: {version}")
+    entry = _version_entry(version)
+    total = int(total)
+    for spec in entry['layouts']:
+        if spec['max_questions'] is None or total <= spec['max_questions']:
+            return SheetLayout(version, entry['page'], spec, total, entry.get('student_id'))
+    raise ValueError(f"No layout for {total} questions in sheet version {version}")
+
+
+@lru_cache(maxsize=64)
+def abcd_template(bubble_px, gap_px):
+    """Zero-mean 1-D horizontal profile of 4 bubbles (dark border / bright interior)
+    for NCC search, and its norm. Returns (template, norm); template is read-only."""
+    spacing_px = bubble_px + gap_px
+    template_len = 4 * bubble_px + 3 * gap_px
+    r = bubble_px // 2
+    border_w = max(2, r // 4)
+    xs = np.arange(template_len)
+    template = np.full(template_len, 0.5)
+    for bi in range(4):
+        dist = np.abs(xs - (bi * spacing_px + bubble_px // 2))
+        inside = dist <= r
+        template[inside & (dist > r - border_w)] = 0.0  # dark border
+        template[inside & (dist <= r - border_w)] = 1.0  # bright interior
+    template = template - np.mean(template)
+    template.flags.writeable = False
+    return template, float(np.sqrt(np.sum(template ** 2)))
+
+
+@lru_cache(maxsize=64)
+def bubble_masks(bubble_px):
+    """Masks for a bubble of diameter bubble_px on a square patch centred on it:
+    disc (interior, well inside the printed outline), outline (the printed stroke,
+    used for re-centering) and ring (paper just outside the stroke, clear of
+    neighbours even for 1.2mm gaps).
+    Returns (disc, outline, ring, half) — boolean masks and the patch half-size; read-only."""
+    DISC_R = 0.34      # x diameter
+    OUTLINE_R = 0.50   # printed circle radius
+    OUTLINE_W = 0.06   # half-width of the stroke band
+    RING_IN = 0.57
+    RING_OUT = 0.66
+    half = max(3, int(np.ceil(bubble_px * RING_OUT)))
+    yy, xx = np.mgrid[-half:half + 1, -half:half + 1]
+    dist = np.sqrt(xx * xx + yy * yy)
+    disc = dist <= max(1.5, bubble_px * DISC_R)
+    outline = np.abs(dist - bubble_px * OUTLINE_R) <= max(1.0, bubble_px * OUTLINE_W)
+    ring = (dist >= bubble_px * RING_IN) & (dist <= max(bubble_px * RING_OUT, bubble_px * RING_IN + 1.5))
+    for m in (disc, outline, ring):
+        m.flags.writeable = False
+    return disc, outline, ring, half
@@ -4,8 +4,14 @@ import { execFile } from 'child_process';
 import { promisify } from 'util';
 import path from 'path';
 import fs from 'fs';
+import net from 'net';
 
 const execFileAsync = promisify(execFile);
+// Formula OCR server: a running one answers a connect at once and, with the model
+// loaded, infers in ~1s per image; past these budgets fall back to spawning instead
+const OCR_SOCKET_CONNECT_MS = 2000;
+const OCR_SOCKET_REPLY_MS = 10000;
+const OCR_SOCKET_PER_IMAGE_MS = 2000;
 
 type DetectedContentType = 'math' | 'physics' | 'chemistry' | 'biology' | 'literature' | 'history' | 'english' | 'generic';
 
@@ -521,10 +527,37 @@ export class SmartUniversalParser extends BaseParser {
 
     console.log(`[OCR] ${ocrTargets.length} formula images to OCR...`);
 
+    const imagePaths = ocrTargets.map(t => t.filePath);
+    const applyResults = (results: Record<string, string>) => {
+      let ocrCount = 0;
+
+      for (const target of ocrTargets) {
+        const latex = results[target.filePath];
+        if (latex && latex.length > 0) {
+          // Wrap in \(...\) delimiters for rendering
+          target.variant.text = `\\(${latex}\\)`;
+          ocrCount++;
+        }
+      }
+
+      console.log(`[OCR] ${ocrCount}/${ocrTargets.length} formulas recognized`);
+    };
+
+    // Model already loaded in `formula_ocr.py --serve --socket` — only inference time
+    const socketPath = process.env.FORMULA_OCR_SOCKET;
+    if (socketPath) {
+      try {
+        applyResults(await this.ocrViaServer(socketPath, imagePaths));
+        return;
+      } catch (err: unknown) {
+        const msg = err instanceof Error ? err.message : String(err);
+        console.warn(`[OCR] Formula OCR server unavailable (${msg}), spawning formula_ocr.py`);
+      }
+    }
+
     // Call Python formula_ocr.py in batch mode
     const scriptPath = path.join(__dirname, '..', '..', '..', 'python', 'formula_ocr.py');
     const pythonPaths = ['python', 'py', 'python3'];
-    const imagePaths = ocrTargets.map(t => t.filePath);
 
     for (const pyPath of pythonPaths) {
       try {
@@ -534,19 +567,7 @@ export class SmartUniversalParser extends BaseParser {
           { timeout: 120000, maxBuffer: 10 * 1024 * 1024 }
         );
 
-        const results: Record<string, string> = JSON.parse(stdout.trim());
-        let ocrCount = 0;
-
-        for (const target of ocrTargets) {
-          const latex = results[target.filePath];
-          if (latex && latex.length > 0) {
-            // Wrap in \(...\) delimiters for rendering
-            target.variant.text = `\\(${latex}\\)`;
-            ocrCount++;
-          }
-        }
-
-        console.log(`[OCR] ${ocrCount}/${ocrTargets.length} formulas recognized`);
+        applyResults(JSON.parse(stdout.trim()));
         return;
       } catch (err: unknown) {
         const msg = err instanceof Error ? err.message : String(err);
@@ -561,6 +582,50 @@ export class SmartUniversalParser extends BaseParser {
     console.warn('[OCR] Python not available for formula OCR');
   }
 
+  /**
+   * One JSONL request to the formula OCR server; rejects on connect error, timeout
+   * (short connect, then a reply budget by image count) or an {"error"} reply
+   * (e.g. "busy" when its queue is full).
+   */
+  private ocrViaServer(socketPath: string, imagePaths: string[]): Promise<Record<string, string>> {
+    return new Promise((resolve, reject) => {
+      const socket = net.createConnection(socketPath);
+      let buffer = '';
+      let settled = false;
+      let timer = setTimeout(() => socket.destroy(new Error('connect timeout')), OCR_SOCKET_CONNECT_MS);
+      const settle = (err: Error | null, results?: Record<string, string>) => {
+        if (settled) return;
+        settled = true;
+        clearTimeout(timer);
+        socket.removeAllListeners('data');
+        socket.end();
+        if (err) reject(err);
+        else resolve(results || {});
+      };
+      // Decoder keeps multi-byte characters (paths are reply keys) intact across chunks
+      socket.setEncoding('utf8');
+      socket.on('connect', () => {
+        clearTimeout(timer);
+        const replyMs = OCR_SOCKET_REPLY_MS + OCR_SOCKET_PER_IMAGE_MS * imagePaths.length;
+        timer = setTimeout(() => socket.destroy(new Error('timeout')), replyMs);
+        socket.write(JSON.stringify({ paths: imagePaths }) + '\n');
+      });
+      socket.on('data', (chunk: string) => {
+        buffer += chunk;
+        const end = buffer.indexOf('\n');
+        if (end < 0) return;
+        try {
+          const reply = JSON.parse(buffer.slice(0, end));
+          settle(reply.error ? new Error(reply.error) : null, reply.results);
+        } catch (err) {
+          settle(err instanceof Error ? err : new Error(String(err)));
+        }
+      });
+      socket.on('error', err => settle(err));
+      socket.on('close', () => settle(new Error('connection closed')));
+    });
+  }
+
   /**
    * AI validation — fix questions with < 4 variants using Groq AI
    * Only sends the problematic questions' raw text to AI, not the entire document